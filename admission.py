@@ -0,0 +1,146 @@
+"""Admission control for Slack requests, run on the raw body before any parsing or database work.
+
+Each POST to /slack/* goes through the cheapest checks first:
+
+1. The body is at most `max_body_bytes`.
+2. A signing secret is configured; without one every request is refused
+   unless `verify_signatures` is turned off for local development.
+3. X-Slack-Request-Timestamp is within `max_age` seconds of now, which
+   stops replays of captured requests.
+4. X-Slack-Signature is the HMAC of the timestamp and raw body under the
+   signing secret.
+5. The team, found in the raw body, has a token left in its bucket of
+   `team_rate` requests per second with bursts of `team_burst`.
+6. Under load, events are shed by value: reactions once the load reaches
+   `shed_reactions_at`, messages at `shed_messages_at`. Slash commands
+   and other events are never shed.
+
+Load is the fuller of `max_inflight` requests in flight and the fraction
+returned by `load`, e.g. the event queue's fill. Shed events are answered
+200 with X-Slack-No-Retry so Slack does not send them again; a rate-limited
+team gets a 429 so Slack retries later. Each rejection is counted in
+`admission_rejections_total` by reason.
+"""
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from instrumentation import stats
+from slack_delivery import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+Rejection = namedtuple('Rejection', 'reason status body headers')
+
+# Matched on the raw body. A quote inside a JSON string is escaped, so message text cannot fake these.
+JSON_TEAM_ID = re.compile(rb'"team_id"\s*:\s*"([^"]+)"')
+FORM_TEAM_ID = re.compile(rb'(?:^|&)team_id=([^&]*)')
+REACTION_EVENT = re.compile(rb'"type"\s*:\s*"reaction_(?:added|removed)"')
+MESSAGE_EVENT = re.compile(rb'"type"\s*:\s*"message"')
+
+stats.describe('admission_rejections_total', "Slack requests rejected before processing, by reason")
+
+
+def team_id_from_body(body, content_type):
+    pattern = FORM_TEAM_ID if 'form' in (content_type or '') else JSON_TEAM_ID
+    match = pattern.search(body)
+    return match.group(1).decode('utf-8', 'replace') if match else None
+
+
+def event_priority(body):
+    """'reaction', 'message' or None for an event body; None is never shed."""
+    if REACTION_EVENT.search(body):
+        return 'reaction'
+    if MESSAGE_EVENT.search(body):
+        return 'message'
+    return None
+
+
+class Admission:
+    """Decides whether a Slack request is processed; see the module docstring."""
+
+    def __init__(self, verifier, max_age=300, max_body_bytes=1024 * 1024, team_rate=50.0, team_burst=500,
+                 shed_reactions_at=0.7, shed_messages_at=0.9, max_inflight=256, load=None, verify_signatures=True):
+        # A None verifier rejects every request, unless verify_signatures is off for local development
+        self.verifier = verifier
+        self.verify_signatures = verify_signatures
+        self.max_age = max_age
+        self.max_body_bytes = max_body_bytes
+        self.team_limiter = RateLimiter(rate=team_rate, burst=team_burst) if team_rate > 0 else None
+        self.shed_at = {'reaction': shed_reactions_at, 'message': shed_messages_at}
+        self.max_inflight = max_inflight
+        self.load = load
+        self._inflight = 0
+        self._lock = threading.Lock()
+        if verifier is None and verify_signatures:
+            logger.error("SLACK_SIGNING_SECRET is not set, every Slack request will be rejected")
+        elif not verify_signatures:
+            logger.warning("ADMISSION_VERIFY_SIGNATURES is off, Slack request signatures are not checked")
+
+    def guards(self, method, path):
+        return method == 'POST' and path.startswith('/slack/')
+
+    def oversized(self, content_length):
+        """Rejection for a declared Content-Length over the limit, checked before the body is read."""
+        if content_length is not None and content_length > self.max_body_bytes:
+            return self.reject('too_large', 413, "Request body too large")
+        return None
+
+    def check(self, path, headers, body, content_type=None):
+        """Returns a Rejection, or None if the request is admitted and must later be released()."""
+        if len(body) > self.max_body_bytes:
+            return self.reject('too_large', 413, "Request body too large")
+
+        if self.verify_signatures:
+            if self.verifier is None:
+                return self.reject('no_signing_secret', 401, "Request signatures cannot be verified")
+            timestamp = headers.get('X-Slack-Request-Timestamp', '')
+            try:
+                age = abs(time.time() - int(timestamp))
+            except ValueError:
+                return self.reject('bad_signature', 401, "Invalid request signature")
+            if age > self.max_age:
+                return self.reject('stale_timestamp', 401, "Stale request timestamp")
+            expected = self.verifier.generate_signature(timestamp=timestamp, body=body)
+            if not hmac.compare_digest(expected, headers.get('X-Slack-Signature', '')):
+                return self.reject('bad_signature', 401, "Invalid request signature")
+
+        team_id = team_id_from_body(body, content_type)
+        is_event = path == '/slack/events'
+        if self.team_limiter is not None and team_id and not self.team_limiter.try_acquire(team_id):
+            if is_event:
+                return self.reject('team_rate', 429, "Rate limited", {'Retry-After': '1'})
+            return self.reject('team_rate', 200, self.ephemeral("Too many requests from this workspace, try again in a moment."),
+                               {'Content-Type': 'application/json'})
+
+        if is_event:
+            priority = event_priority(body)
+            if priority is not None and self.current_load() >= self.shed_at[priority]:
+                return self.reject(f'shed_{priority}', 200, "", {'X-Slack-No-Retry': '1'})
+
+        with self._lock:
+            self._inflight += 1
+        return None
+
+    def release(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def current_load(self):
+        load = self._inflight / self.max_inflight if self.max_inflight > 0 else 0.0
+        if self.load is not None:
+            load = max(load, self.load())
+        return load
+
+    def reject(self, reason, status, body, headers=None):
+        stats.inc('admission_rejections_total', reason=reason)
+        logger.debug(f"Rejected Slack request: {reason}")
+        return Rejection(reason, status, body, headers or {})
+
+    @staticmethod
+    def ephemeral(message):
+        return json.dumps({'response_type': 'ephemeral', 'text': message})
@@ -1,210 +1,518 @@
-from flask import Flask, request, Response
+from flask import Flask, g, request, Response, jsonify, stream_with_context
+import hmac
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, groupby
+from operator import itemgetter
 from dotenv import load_dotenv
 from slack_sdk import WebClient
 from slack_sdk.signature import SignatureVerifier
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from slack_sdk.webhook import WebhookClient
+from sqlalchemy import bindparam, text
 import logging
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
+from datetime import datetime, timedelta
 from apscheduler.triggers.cron import CronTrigger
 import pytz
+from admission import Admission
+from metrics_buffer import MetricsBuffer
+from metrics_export import EXPORT_FORMATS, parse_date, stream_export
+from event_queue import EventDispatcher, SeenSet, SharedSeenSet, REJECTED
+from metrics_store import (
+    buckets_query, channel_activity, day_bucket, response_time_percentiles, rollup_hourly, since, utcnow,
+)
+from slack_delivery import RateLimiter, call_with_retry, post_thread
+from report_render import channel_line, render_report, section
+from slack_clients import SlackClientRegistry
+from leaderboard_cache import LeaderboardCache
+from instrumentation import stats, instrument_flask
+from database import Database, env_flag
+from backfill import backfill_team
+from retention import ensure_partitions, run_maintenance
+from scheduling import (
+    LOCAL_JOBSTORE, acquire_job_run, build_scheduler, claim_report_runs,
+    finish_job_run, finish_report_runs, previous_fire_time,
+)
 
-# Initialize Flask app
+# Initialize Flask app; create_app() builds everything the routes use, on the first request at the latest
 app = Flask(__name__)
+instrument_flask(app)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN')
-SLACK_SIGNING_SECRET = os.getenv('SLACK_SIGNING_SECRET')
-DATABASE_URL = os.getenv('DATABASE_URL')
+# Scheduled reports: header and timeframe per period
+REPORT_PERIODS = {
+    'weekly': ("Weekly Metrics Report", '7 days'),
+    'monthly': ("Monthly Metrics Report", '30 days'),
+    'yearly': ("Yearly Metrics Report", '365 days'),
+}
+SCHEDULER_TIMEZONE = pytz.timezone('Asia/Kolkata')
+# Started by start_scheduler() in processes that opt in
+scheduler = None
+
+_initialized = False
+_init_lock = threading.Lock()
+
+def create_app():
+    """Reads the configuration and builds the app's clients, caches and pools.
+
+    Nothing here connects to the database or Slack or starts a thread, so it
+    is safe to call in a gunicorn `--preload` master: connections are opened
+    and worker threads started on first use in each process. The scheduler
+    only runs where start_scheduler() is called.
+    """
+    global _initialized
+    global verifier, admission, database, Session, slack_clients, slack_client
+    global leaderboard_cache, LEADERBOARD_CACHE_MIN_K, metrics_buffer, INGEST_MODE, seen_events, event_dispatcher
+    global SCHEDULER_MODE, SCHEDULER_MISFIRE_GRACE, SCHEDULER_LEASE_SECONDS, SCHEDULER_CATCHUP_HOURS
+    global REPORT_POST_WORKERS, REPORT_FETCH_SIZE, REPORT_MAX_PENDING_MESSAGES, command_executor, report_limiter
+    global BACKFILL_ON_INSTALL, backfill_executor
+    
+    with _init_lock:
+        if _initialized:
+            return app
+        
+        # Configure logging; DEBUG formats log lines on every request, so it is opt-in
+        logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+        
+        # Load environment variables
+        load_dotenv()
+        
+        # Initialize signature verifier
+        signing_secret = os.getenv('SLACK_SIGNING_SECRET')
+        verifier = SignatureVerifier(signing_secret) if signing_secret else None
+        
+        # Initialize database from DATABASE_URL and the DB_* pool settings; connects on first use
+        database = Database.from_env()
+        Session = database.session
+        
+        # Initialize per-workspace Slack clients; slack_client serves calls that need no team token
+        slack_clients = SlackClientRegistry(
+            Session,
+            default_token=os.getenv('SLACK_BOT_TOKEN'),
+            base_url=os.getenv('SLACK_API_URL', WebClient.BASE_URL),
+            ttl=float(os.getenv('SLACK_TOKEN_CACHE_TTL', '3600')),
+            max_size=int(os.getenv('SLACK_TOKEN_CACHE_SIZE', '1000'))
+        )
+        slack_client = slack_clients.default_client
+        
+        # Initialize leaderboard cache for slash commands; a miss fetches at least the top LEADERBOARD_CACHE_MIN_K users
+        leaderboard_cache = LeaderboardCache(
+            ttl=float(os.getenv('LEADERBOARD_CACHE_TTL', '30')),
+            max_size=int(os.getenv('LEADERBOARD_CACHE_SIZE', '1024'))
+        )
+        LEADERBOARD_CACHE_MIN_K = int(os.getenv('LEADERBOARD_CACHE_MIN_K', '25'))
+        
+        # Retry de-duplication is shared through the database so it holds across workers and instances;
+        # first deliveries are recorded in batches with the metrics buffer's flushes
+        dedupe_ttl = float(os.getenv('EVENT_DEDUPE_TTL', '600'))
+        if os.getenv('EVENT_DEDUPE_STORE', 'database') == 'memory':
+            seen_events = SeenSet(ttl=dedupe_ttl)
+        else:
+            seen_events = SharedSeenSet(Session, ttl=dedupe_ttl)
+        
+        # Initialize write-behind buffer for event counters; flushed teams drop their cached leaderboards
+        metrics_buffer = MetricsBuffer(
+            Session,
+            max_keys=int(os.getenv('METRICS_FLUSH_MAX_KEYS', '500')),
+            max_staleness=float(os.getenv('METRICS_FLUSH_INTERVAL', '5')),
+            on_flush=leaderboard_cache.invalidate_teams,
+            on_write=seen_events.write if isinstance(seen_events, SharedSeenSet) else None
+        )
+        
+        # Event ingestion: 'sync' processes events on the request thread, 'async' acknowledges
+        # immediately and hands them to a pool of background workers
+        INGEST_MODE = os.getenv('INGEST_MODE', 'sync')
+        event_dispatcher = EventDispatcher(
+            process_event,
+            workers=int(os.getenv('INGEST_WORKERS', '4')),
+            max_queue=int(os.getenv('INGEST_QUEUE_SIZE', '1000')),
+            full_policy=os.getenv('INGEST_QUEUE_FULL_POLICY', 'block'),
+            block_timeout=float(os.getenv('INGEST_BLOCK_TIMEOUT', '1'))
+        )
+        
+        # Checks every Slack request on its raw body before it is parsed; sheds events as the queue fills
+        admission = Admission(
+            verifier,
+            max_age=int(os.getenv('ADMISSION_MAX_AGE', '300')),
+            max_body_bytes=int(os.getenv('ADMISSION_MAX_BODY_BYTES', str(1024 * 1024))),
+            team_rate=float(os.getenv('ADMISSION_TEAM_RATE', '50')),
+            team_burst=int(os.getenv('ADMISSION_TEAM_BURST', '500')),
+            shed_reactions_at=float(os.getenv('ADMISSION_SHED_REACTIONS_AT', '0.7')),
+            shed_messages_at=float(os.getenv('ADMISSION_SHED_MESSAGES_AT', '0.9')),
+            max_inflight=int(os.getenv('ADMISSION_MAX_INFLIGHT', '256')),
+            load=event_dispatcher.fill,
+            verify_signatures=env_flag('ADMISSION_VERIFY_SIGNATURES', 'true')
+        )
+        
+        # Scheduler settings. SCHEDULER_MODE 'cluster' keeps the job definitions in the database
+        # for every instance to share; in both modes each firing runs in only one process
+        SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'local')
+        SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', '3600'))
+        # How long a firing or team report stays claimed by a process that has not finished it
+        SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', '3600'))
+        # Report firings missed within this many hours are run once at startup; 0 disables it
+        SCHEDULER_CATCHUP_HOURS = float(os.getenv('SCHEDULER_CATCHUP_HOURS', '24'))
+        
+        REPORT_POST_WORKERS = int(os.getenv('REPORT_POST_WORKERS', '8'))
+        # Rows fetched per round trip from the report cursor, and rendered messages waiting to be posted
+        REPORT_FETCH_SIZE = int(os.getenv('REPORT_FETCH_SIZE', '1000'))
+        REPORT_MAX_PENDING_MESSAGES = int(os.getenv('REPORT_MAX_PENDING_MESSAGES', str(REPORT_POST_WORKERS * 2)))
+        
+        # Slash commands are acknowledged at once and completed on this pool
+        command_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('COMMAND_WORKERS', '4')),
+            thread_name_prefix='slash-command'
+        )
+        report_limiter = RateLimiter(rate=float(os.getenv('REPORT_TEAM_RATE', '1')), burst=1)
+        
+        # History backfills run one team at a time, off the request threads
+        BACKFILL_ON_INSTALL = env_flag('BACKFILL_ON_INSTALL', 'false')
+        backfill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backfill')
+        
+        # Queue, buffer and cache gauges for /internal/stats
+        stats.gauge('event_queue_depth', event_dispatcher.qsize, "Events waiting for an ingestion worker")
+        stats.gauge('metrics_buffer_pending_keys', lambda: len(metrics_buffer), "Metric keys buffered but not yet written")
+        stats.gauge('event_dedupe_keys', lambda: len(seen_events), "event_ids remembered for retry de-duplication")
+        stats.gauge(
+            'leaderboard_cache_lookups',
+            lambda: {(('result', 'hit'),): leaderboard_cache.hits, (('result', 'miss'),): leaderboard_cache.misses},
+            "Leaderboard cache lookups by result"
+        )
+        
+        _initialized = True
+        return app
 
-# Initialize Slack client and signature verifier
-slack_client = WebClient(token=SLACK_BOT_TOKEN)
-verifier = SignatureVerifier(SLACK_SIGNING_SECRET)
+BOT_USER_ID = 'U097KCQHADC'
 
-# Initialize database
-engine = create_engine(DATABASE_URL, connect_args={'sslmode': 'require'})
-Session = sessionmaker(bind=engine)
+@app.before_request
+def initialize_app():
+    # Serving the module-level app directly (`gunicorn app:app`, `flask run`) configures it on the first request
+    if not _initialized:
+        create_app()
 
-# Initialize scheduler
-scheduler = BackgroundScheduler(timezone=pytz.timezone('Asia/Kolkata'))
-scheduler.start()
+@app.before_request
+def admit_slack_request():
+    if not admission.guards(request.method, request.path):
+        return None
+    rejection = admission.oversized(request.content_length) or admission.check(
+        request.path, request.headers, request.get_data(cache=True), request.content_type
+    )
+    if rejection is not None:
+        return Response(rejection.body, status=rejection.status, headers=rejection.headers)
+    g.slack_admitted = True
 
-def verify_request():
-    return True
+@app.teardown_request
+def release_slack_request(exc):
+    if g.pop('slack_admitted', False):
+        admission.release()
 
-def get_user_metrics(session, team_id, limit=5, timeframe='1 day'):
-    query = text("""
+def get_user_metrics(session, team_id, limit=5, timeframe='1 day', order='top'):
+    direction = 'DESC' if order == 'top' else 'ASC'
+    query = text(f"""
         SELECT 
             user_id,
             SUM(message_count) as message_count,
             SUM(reaction_count) as reaction_count,
-            AVG(response_time) as avg_response_time
-        FROM metrics
-        WHERE team_id = :team_id
-        AND user_id != :bot_user_id
-        AND recorded_at >= NOW() - INTERVAL :timeframe
+            SUM(response_time_sum) / NULLIF(SUM(response_count), 0) as avg_response_time
+        FROM (
+{buckets_query("user_id, message_count, reaction_count, response_time_sum, response_count")}
+        ) buckets
+        WHERE user_id != :bot_user_id
         GROUP BY user_id
-        ORDER BY message_count DESC, reaction_count DESC
+        ORDER BY message_count {direction}, reaction_count {direction}
         LIMIT :limit
     """)
     
-    result = session.execute(query, {'team_id': team_id, 'timeframe': timeframe, 'limit': limit, 'bot_user_id': 'U097KCQHADC'}).fetchall()
+    since_time = since(timeframe)
+    result = session.execute(query, {'team_id': team_id, 'since': since_time, 'limit': limit, 'bot_user_id': BOT_USER_ID}).fetchall()
     
     if not result:
         return []
-        
-    metrics = []
-    for row in result:
-        user_id, msg_count, react_count, avg_response = row
-        avg_response_str = f"{avg_response:.2f}s" if avg_response else "N/A"
-        metrics.append({
-            'user_id': user_id,
-            'message_count': int(msg_count),
-            'reaction_count': int(react_count),
-            'avg_response_time': avg_response_str
-        })
     
-    return metrics
+    percentiles = response_time_percentiles(session, team_id, [row[0] for row in result], since_time)
+    return [metric_from_row(*row, percentiles=percentiles.get(row[0])) for row in result]
 
-def format_slack_message(metrics, header="Top Active Users", show_bottom=False, limit=None):
-    blocks = [
-        {"type": "header", "text": {"type": "plain_text", "text": header}},
-        {"type": "divider"}
-    ]
-    
-    text_lines = []
-    if metrics:
-        for metric in metrics:
-            line = f"*User <@{metric['user_id']}>:* 👁️ {metric['message_count']} messages, 👍 {metric['reaction_count']} reactions, ⏱️ {metric['avg_response_time']} avg response"
-            text_lines.append(line)
-        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "\n".join(text_lines)}})
-    else:
-        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": "No user activity found."}})
+def get_cached_user_metrics(session, team_id, limit=5, timeframe='1 day', order='top'):
+    metrics = leaderboard_cache.get(team_id, timeframe, limit, order=order)
+    if metrics is not None:
+        return metrics
     
-    if show_bottom and limit:
-        blocks.extend([
-            {"type": "header", "text": {"type": "plain_text", "text": f"Bottom {limit} Active Users"}},
-            {"type": "divider"},
-            {"type": "section", "text": {"type": "mrkdwn", "text": "\n".join(reversed(text_lines[-limit:])) if text_lines else "No user activity found."}}
-        ])
+    k = max(limit, LEADERBOARD_CACHE_MIN_K)
+    metrics = get_user_metrics(session, team_id, limit=k, timeframe=timeframe, order=order)
+    leaderboard_cache.put(team_id, timeframe, k, metrics, order=order)
+    return metrics[:limit]
+
+def format_seconds(seconds):
+    return f"{seconds:.2f}s" if seconds else "N/A"
+
+def metric_from_row(user_id, msg_count, react_count, avg_response, percentiles=None):
+    p50, p95 = percentiles or (None, None)
+    return {
+        'user_id': user_id,
+        'message_count': int(msg_count),
+        'reaction_count': int(react_count),
+        'avg_response_time': format_seconds(avg_response),
+        'p50_response_time': format_seconds(p50),
+        'p95_response_time': format_seconds(p95)
+    }
+
+@stats.timed('scheduler_job_duration_seconds', job='metrics_rollup')
+def rollup_metrics(run_key=None):
+    logger.info("Running scheduled metrics rollup")
+    with Session() as session:
+        # Days being rolled up, or backfilled earlier, may be older than any daily partition
+        ensure_partitions(session, months_ahead=int(os.getenv('METRICS_PARTITIONS_AHEAD', '3')))
+        rollup_hourly(session, retention_hours=int(os.getenv('METRICS_HOURLY_RETENTION_HOURS', '48')))
+
+@stats.timed('scheduler_job_duration_seconds', job='event_dedupe_expiry')
+def expire_seen_events(run_key=None):
+    if isinstance(seen_events, SharedSeenSet):
+        deleted = seen_events.expire()
+        logger.info(f"Expired {deleted} remembered event_ids")
+
+@stats.timed('scheduler_job_duration_seconds', job='metrics_maintenance')
+def maintain_metrics(run_key=None):
+    logger.info("Running scheduled metrics maintenance")
+    with Session() as session:
+        return run_maintenance(
+            session,
+            daily_retention_days=int(os.getenv('METRICS_DAILY_RETENTION_DAYS', '400')),
+            monthly_retention_months=int(os.getenv('METRICS_MONTHLY_RETENTION_MONTHS', '0')),
+            months_ahead=int(os.getenv('METRICS_PARTITIONS_AHEAD', '3')),
+            keep_detached=env_flag('METRICS_KEEP_DETACHED_PARTITIONS', 'false')
+        )
+
+def stream_report_rows(session, timeframe, team_ids=None):
+    """Yields (team_id, metric) for every team's leaderboard, grouped by team, from a server-side cursor.
+
+    `team_ids`, if given, limits the report to those teams. Response-time
+    percentiles are merged for each batch of REPORT_FETCH_SIZE rows.
+    """
+    query = text(f"""
+        SELECT
+            team_id,
+            user_id,
+            SUM(message_count) as message_count,
+            SUM(reaction_count) as reaction_count,
+            SUM(response_time_sum) / NULLIF(SUM(response_count), 0) as avg_response_time
+        FROM (
+{buckets_query("team_id, user_id, message_count, reaction_count, response_time_sum, response_count", per_team=False, where="team_id IN :team_ids" if team_ids is not None else None)}
+        ) buckets
+        WHERE user_id != :bot_user_id
+        GROUP BY team_id, user_id
+        ORDER BY team_id, message_count DESC, reaction_count DESC
+    """).execution_options(yield_per=REPORT_FETCH_SIZE)
     
-    text = "\n".join(text_lines) if text_lines else "No user activity found."
-    return blocks, text
+    since_time = since(timeframe)
+    params = {'since': since_time, 'bot_user_id': BOT_USER_ID}
+    if team_ids is not None:
+        query = query.bindparams(bindparam('team_ids', expanding=True))
+        params['team_ids'] = list(team_ids)
+    result = session.execute(query, params)
+    for rows in result.partitions(REPORT_FETCH_SIZE):
+        for team_id, team_rows in groupby(rows, key=itemgetter(0)):
+            team_rows = list(team_rows)
+            percentiles = response_time_percentiles(session, team_id, [row[1] for row in team_rows], since_time)
+            for _, *metric in team_rows:
+                yield team_id, metric_from_row(*metric, percentiles=percentiles.get(metric[0]))
 
-def send_weekly_report():
-    from sqlalchemy import text 
-    logger.info("Running scheduled weekly report")
-    session = Session()
-    try:
-        teams = session.execute(text("SELECT DISTINCT team_id FROM metrics")).fetchall()
-        for team in teams:
-            team_id = team[0]
-            report_channel = session.execute(
-                text("SELECT channel_id FROM report_channels WHERE team_id = :team_id"),
-                {'team_id': team_id}
-            ).fetchone()
-            channel_id = report_channel[0] if report_channel else "#general"
-
-            # Fetch all users (no limit)
-            metrics = get_user_metrics(session, team_id, limit=999999, timeframe='7 days')
-            blocks, text = format_slack_message(
-                metrics,
-                header="Weekly Metrics Report"
-            )
+def send_report(period, period_key=None):
+    """Posts the `period` report to every team.
 
+    With a `period_key` (set for scheduled firings) each team's report is
+    claimed in report_runs first, and teams whose report for that key was
+    already posted, or is being posted elsewhere, are skipped.
+    """
+    header, timeframe = REPORT_PERIODS[period]
+    logger.info(f"Running scheduled {period} report")
+    started = time.perf_counter()
+    skipped = 0
+    
+    with Session() as session:
+        # Teams with activity in the report window, read through the bucket_start indexes
+        teams = [row[0] for row in session.execute(text(f"""
+            SELECT DISTINCT team_id FROM (
+{buckets_query("team_id", per_team=False)}
+            ) buckets
+        """), {'since': since(timeframe)}).fetchall()]
+        if period_key is not None:
+            claimed = claim_report_runs(session, teams, period, period_key, SCHEDULER_LEASE_SECONDS)
+            skipped = len(teams) - len(claimed)
+            teams = claimed
+        report_channels = dict(session.execute(
+            text("SELECT team_id, channel_id FROM report_channels")
+        ).fetchall())
+        slack_clients.warm(teams)
+        query_seconds = time.perf_counter() - started
+        
+        # Rendered messages are handed to the pool as the cursor is read; the semaphore
+        # stops reading while too many are waiting, so memory stays flat
+        pending_messages = threading.BoundedSemaphore(REPORT_MAX_PENDING_MESSAGES)
+        last_posts = {}
+        
+        def post_message(team_id, channel_id, blocks, message_text, previous):
             try:
-                slack_client.chat_postMessage(channel=channel_id, blocks=blocks, text=text)
-                logger.info(f"Posted scheduled weekly report to team {team_id}, channel {channel_id}")
-            except Exception as e:
-                logger.error(f"Error sending weekly report for {team_id}: {e}")
-    finally:
-        session.close()
+                # Follow-up messages go into the thread of the team's first message
+                thread = previous.result() if previous is not None else None
+                response = call_with_retry(
+                    slack_clients.client_for(team_id).chat_postMessage,
+                    limiter=report_limiter,
+                    limiter_key=team_id,
+                    channel=thread[0] if thread else channel_id,
+                    thread_ts=thread[1] if thread else None,
+                    blocks=blocks,
+                    text=message_text
+                )
+                return thread or (response['channel'], response['ts'])
+            finally:
+                pending_messages.release()
+        
+        def submit_report(executor, team_id, metrics):
+            channel_id = report_channels.get(team_id, "#general")
+            previous = None
+            for blocks, message_text in render_report([(header, metrics)]):
+                pending_messages.acquire()
+                previous = executor.submit(post_message, team_id, channel_id, blocks, message_text, previous)
+            last_posts[team_id] = (channel_id, previous)
+            if period_key is not None:
+                previous.add_done_callback(lambda post: record_report_run(team_id, period, period_key, post))
+        
+        with ThreadPoolExecutor(max_workers=REPORT_POST_WORKERS) as executor:
+            report_rows = stream_report_rows(session, timeframe, team_ids=teams if period_key is not None else None)
+            for team_id, team_rows in groupby(report_rows, key=itemgetter(0)):
+                submit_report(executor, team_id, (metric for _, metric in team_rows))
+            for team_id in teams:
+                if team_id not in last_posts:
+                    submit_report(executor, team_id, [])
+    
+    failures = []
+    for team_id, (channel_id, last_post) in last_posts.items():
+        try:
+            last_post.result()
+            logger.info(f"Posted scheduled {period} report to team {team_id}, channel {channel_id}")
+        except Exception as e:
+            logger.error(f"Error sending {period} report for {team_id}: {e}")
+            failures.append({'team_id': team_id, 'error': str(e)})
+    
+    total_seconds = time.perf_counter() - started
+    summary = {
+        'period': period,
+        'teams': len(last_posts),
+        'posted': len(last_posts) - len(failures),
+        'failed': failures,
+        'skipped': skipped,
+        'query_seconds': round(query_seconds, 3),
+        'post_seconds': round(total_seconds - query_seconds, 3),
+        'total_seconds': round(total_seconds, 3)
+    }
+    logger.info(f"Finished {period} report: {summary}")
+    return summary
 
-def send_monthly_report():
-    from sqlalchemy import text  
-    logger.info("Running scheduled monthly report")
-    session = Session()
+def record_report_run(team_id, period, period_key, post):
+    # Recorded as soon as the team's last message is posted, so a crash re-posts as little as possible
+    status = 'failed' if post.exception() is not None else 'posted'
     try:
-        teams = session.execute(text("SELECT DISTINCT team_id FROM metrics")).fetchall()
-        for team in teams:
-            team_id = team[0]
-            report_channel = session.execute(
-                text("SELECT channel_id FROM report_channels WHERE team_id = :team_id"),
-                {'team_id': team_id}
-            ).fetchone()
-            channel_id = report_channel[0] if report_channel else "#general"
-
-            # Fetch all users (no limit)
-            metrics = get_user_metrics(session, team_id, limit=999999, timeframe='30 days')
-            blocks, text = format_slack_message(
-                metrics,
-                header="Monthly Metrics Report"
-            )
+        with Session() as session:
+            finish_report_runs(session, [team_id], period, period_key, status)
+    except Exception as e:
+        logger.error(f"Failed to record {period} report {period_key} for {team_id} as {status}: {e}")
 
-            try:
-                slack_client.chat_postMessage(channel=channel_id, blocks=blocks, text=text)
-                logger.info(f"Posted scheduled monthly report to team {team_id}, channel {channel_id}")
-            except Exception as e:
-                logger.error(f"Error sending monthly report for {team_id}: {e}")
-    finally:
-        session.close()
+@stats.timed('scheduler_job_duration_seconds', job='weekly_report')
+def send_weekly_report(run_key=None):
+    return send_report('weekly', run_key)
 
-def send_yearly_report():
-    from sqlalchemy import text 
-    logger.info("Running scheduled yearly report")
-    session = Session()
-    try:
-        teams = session.execute(text("SELECT DISTINCT team_id FROM metrics")).fetchall()
-        for team in teams:
-            team_id = team[0]
-            report_channel = session.execute(
-                text("SELECT channel_id FROM report_channels WHERE team_id = :team_id"),
-                {'team_id': team_id}
-            ).fetchone()
-            channel_id = report_channel[0] if report_channel else "#general"
-
-            metrics = get_user_metrics(session, team_id, limit=999999, timeframe='365 days')
-            blocks, text = format_slack_message(
-                metrics,
-                header="Yearly Metrics Report"
-            )
+@stats.timed('scheduler_job_duration_seconds', job='monthly_report')
+def send_monthly_report(run_key=None):
+    return send_report('monthly', run_key)
 
-            try:
-                slack_client.chat_postMessage(channel=channel_id, blocks=blocks, text=text)
-                logger.info(f"Posted scheduled yearly report to team {team_id}, channel {channel_id}")
-            except Exception as e:
-                logger.error(f"Error sending yearly report for {team_id}: {e}")
-    finally:
-        session.close()
+@stats.timed('scheduler_job_duration_seconds', job='yearly_report')
+def send_yearly_report(run_key=None):
+    return send_report('yearly', run_key)
 
 @app.route('/test-weekly-report', methods=['GET'])
 def test_weekly_report():
-    send_weekly_report()
-    return "Weekly report triggered"
+    return jsonify(send_weekly_report())
 
 @app.route('/test-monthly-report', methods=['GET'])
 def test_monthly_report():
-    send_monthly_report()
-    return "Monthly report triggered"
+    return jsonify(send_monthly_report())
 
 @app.route('/test-yearly-report', methods=['GET'])
 def test_yearly_report():
-    send_yearly_report()
-    return "Yearly report triggered"
+    return jsonify(send_yearly_report())
 
-@app.route('/slack/install', methods=['GET'])
-def install():
+def bearer_matches(authorization, token):
+    """Compares an Authorization header with `token` in constant time."""
+    return hmac.compare_digest((authorization or '').encode(), f"Bearer {token}".encode())
+
+def internal_denied(authorization):
+    """(message, status) refusing an internal endpoint request, or None. Like export, they are disabled without a token."""
+    token = os.getenv('INTERNAL_STATS_TOKEN')
+    if not token:
+        return "Internal endpoints are disabled", 404
+    if not bearer_matches(authorization, token):
+        return "Unauthorized", 401
+    return None
+
+@app.route('/internal/leaderboard-cache', methods=['GET'])
+def leaderboard_cache_stats():
+    denied = internal_denied(request.headers.get('Authorization'))
+    if denied:
+        return Response(denied[0], status=denied[1])
+    return jsonify(leaderboard_cache.stats())
+
+@app.route('/internal/stats', methods=['GET'])
+def internal_stats():
+    denied = internal_denied(request.headers.get('Authorization'))
+    if denied:
+        return Response(denied[0], status=denied[1])
+    return Response(stats.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/export/metrics', methods=['GET'])
+def export_metrics():
+    """Streams a team's per-user, per-channel totals for [start, end) as CSV or NDJSON.
+
+    Query parameters: team_id, start and end (ISO dates or times in UTC; the
+    last 30 days by default) and format ('csv' or 'ndjson').
+    """
+    token = os.getenv('EXPORT_API_TOKEN')
+    if not token:
+        return Response("Export is disabled", status=404)
+    if not bearer_matches(request.headers.get('Authorization'), token):
+        return Response("Unauthorized", status=401)
+    
+    team_id = request.args.get('team_id')
+    export_format = request.args.get('format', 'csv')
+    if not team_id or export_format not in EXPORT_FORMATS:
+        return Response(f"team_id and a format of {', '.join(EXPORT_FORMATS)} are required", status=400)
+    try:
+        end = parse_date(request.args['end']) if 'end' in request.args else datetime.utcnow()
+        start = parse_date(request.args['start']) if 'start' in request.args else end - timedelta(days=30)
+    except ValueError as e:
+        return Response(f"Invalid date: {e}", status=400)
+    if start >= end:
+        return Response("start must be before end", status=400)
+    
+    logger.info(f"Exporting metrics for team {team_id} from {start} to {end} as {export_format}")
+    filename = f"metrics-{team_id}-{start:%Y%m%d}-{end:%Y%m%d}.{export_format}"
+    return Response(
+        stream_with_context(stream_export(Session, team_id, start, end, export_format, fetch_size=REPORT_FETCH_SIZE)),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+def install_link():
     client_id = os.getenv('SLACK_CLIENT_ID')
     install_url = f"https://slack.com/oauth/v2/authorize?client_id={client_id}&scope=channels:history,channels:read,chat:write,commands,reactions:read,users:read&user_scope="
     return f'<a href="{install_url}">Install to Slack</a>'
 
+@app.route('/slack/install', methods=['GET'])
+def install():
+    return install_link()
+
 @app.route('/slack/oauth_redirect', methods=['GET'])
 def oauth_redirect():
     code = request.args.get('code')
@@ -222,15 +530,10 @@ def oauth_redirect():
             bot_token = response['access_token']
             
             with Session() as session:
-                session.execute(
-                    text("DELETE FROM slack_bots WHERE team_id = :team_id"),
-                    {'team_id': team_id}
-                )
-                session.execute(
-                    text("INSERT INTO slack_bots (team_id, bot_token, created_at) VALUES (:team_id, :bot_token, NOW())"),
-                    {'team_id': team_id, 'bot_token': bot_token}
-                )
-                session.commit()
+                save_bot_token(session, team_id, bot_token)
+            slack_clients.invalidate(team_id)
+            if BACKFILL_ON_INSTALL:
+                backfill_executor.submit(run_backfill, team_id)
             
             return "App installed successfully!"
         else:
@@ -239,215 +542,320 @@ def oauth_redirect():
         logger.error(f"Error during OAuth: {str(e)}")
         return f"Error during OAuth: {str(e)}"
 
+def save_bot_token(session, team_id, bot_token):
+    # A reinstall keeps the first install time, where backfills stop and live counting began
+    session.execute(
+        text("""
+            INSERT INTO slack_bots (team_id, bot_token, created_at) VALUES (:team_id, :bot_token, NOW())
+            ON CONFLICT (team_id) DO UPDATE SET bot_token = EXCLUDED.bot_token
+        """),
+        {'team_id': team_id, 'bot_token': bot_token}
+    )
+    session.commit()
+
+def run_backfill(team_id, days=None, latest=None, workers=None):
+    """Backfills `team_id`'s history with its bot token; returns the summary, or None if it failed to start."""
+    try:
+        return backfill_team(
+            Session,
+            slack_clients.client_for(team_id),
+            team_id,
+            days=days or int(os.getenv('BACKFILL_DAYS', '90')),
+            latest=latest,
+            workers=workers or int(os.getenv('BACKFILL_WORKERS', '4')),
+            tier2_per_minute=float(os.getenv('BACKFILL_TIER2_PER_MINUTE', '20')),
+            tier3_per_minute=float(os.getenv('BACKFILL_TIER3_PER_MINUTE', '50')),
+            bot_user_id=BOT_USER_ID
+        )
+    except Exception as e:
+        logger.error(f"Backfill for team {team_id} failed: {e}")
+        return None
+    finally:
+        leaderboard_cache.invalidate_teams({team_id})
+
+def process_event(payload):
+    event = payload.get('event', {})
+    team_id = payload.get('team_id')
+    
+    if event.get('type') == 'message' and 'subtype' not in event and 'bot_id' not in event:
+        user_id = event['user']
+        channel_id = event['channel']
+        message_ts = float(event['ts'])
+        
+        response_time = None
+        if event.get('thread_ts'):
+            parent_ts = float(event['thread_ts'])
+            response_time = message_ts - parent_ts
+        
+        metrics_buffer.record_message(team_id, user_id, channel_id, response_time=response_time, ts=message_ts)
+        logger.info(f"Recorded message for user {user_id} in channel {channel_id}")
+    
+    elif event.get('type') == 'reaction_added':
+        user_id = event['user']
+        channel_id = event['item']['channel']
+        
+        metrics_buffer.record_reaction(team_id, user_id, channel_id, ts=float(event['event_ts']) if event.get('event_ts') else None)
+        logger.info(f"Recorded reaction for user {user_id} in channel {channel_id}")
+
 @app.route('/slack/events', methods=['POST'])
 def slack_events():
     if request.json.get('type') == 'url_verification':
         return request.json['challenge']
     
-    if not verify_request():
-        return Response("Invalid request signature", status=401)
+    payload = request.json
+    event_id = payload.get('event_id')
     
-    event = request.json.get('event', {})
-    team_id = request.json.get('team_id')
+    # Slack redelivers the same event_id with X-Slack-Retry-Num set when we answer too slowly
+    retry_num = request.headers.get('X-Slack-Retry-Num')
+    if event_id and not seen_events.add(event_id, retry=bool(retry_num)):
+        logger.info(f"Dropping duplicate delivery of event {event_id} (retry {retry_num})")
+        return Response(status=200)
     
-    if event.get('type') == 'message' and 'subtype' not in event and 'bot_id' not in event:
-        with Session() as session:
-            user_id = event['user']
-            channel_id = event['channel']
-            message_ts = float(event['ts'])
-            
-            metric = session.execute(
-                text("SELECT id FROM metrics WHERE team_id = :team_id AND user_id = :user_id AND channel_id = :channel_id"),
-                {'team_id': team_id, 'user_id': user_id, 'channel_id': channel_id}
-            ).fetchone()
-            
-            if metric:
-                session.execute(
-                    text("UPDATE metrics SET message_count = message_count + 1, recorded_at = NOW() WHERE id = :id"),
-                    {'id': metric[0]}
-                )
-            else:
-                session.execute(
-                    text("INSERT INTO metrics (team_id, user_id, channel_id, message_count, reaction_count, recorded_at) VALUES (:team_id, :user_id, :channel_id, 1, 0, NOW())"),
-                    {'team_id': team_id, 'user_id': user_id, 'channel_id': channel_id}
-                )
-            
-            if event.get('thread_ts'):
-                parent_ts = float(event['thread_ts'])
-                response_time = message_ts - parent_ts
-                session.execute(
-                    text("UPDATE metrics SET response_time = :response_time WHERE team_id = :team_id AND user_id = :user_id AND channel_id = :channel_id"),
-                    {'team_id': team_id, 'user_id': user_id, 'channel_id': channel_id, 'response_time': response_time}
-                )
-            
-            session.commit()
-            logger.info(f"Recorded message for user {user_id} in channel {channel_id}")
+    if INGEST_MODE == 'async':
+        if event_dispatcher.submit(payload) == REJECTED:
+            if event_id:
+                seen_events.discard(event_id)
+            return Response("Event queue full", status=503)
+        return Response(status=200)
     
-    elif event.get('type') == 'reaction_added':
-        with Session() as session:
-            user_id = event['user']
-            channel_id = event['item']['channel']
-            
-            metric = session.execute(
-                text("SELECT id FROM metrics WHERE team_id = :team_id AND user_id = :user_id AND channel_id = :channel_id"),
-                {'team_id': team_id, 'user_id': user_id, 'channel_id': channel_id}
-            ).fetchone()
-            
-            if metric:
-                session.execute(
-                    text("UPDATE metrics SET reaction_count = reaction_count + 1, recorded_at = NOW() WHERE id = :id"),
-                    {'id': metric[0]}
-                )
-            else:
-                session.execute(
-                    text("INSERT INTO metrics (team_id, user_id, channel_id, message_count, reaction_count, recorded_at) VALUES (:team_id, :user_id, :channel_id, 0, 1, NOW())"),
-                    {'team_id': team_id, 'user_id': user_id, 'channel_id': channel_id}
-                )
-            
-            session.commit()
-            logger.info(f"Recorded reaction for user {user_id} in channel {channel_id}")
+    try:
+        process_event(payload)
+    except Exception:
+        if event_id:
+            seen_events.discard(event_id)
+        raise
     
     return Response(status=200)
 
-@app.route('/slack/metrics', methods=['POST'])
-def metrics():
-    logger.debug(f"Metrics command request received: {request.form}")
-    logger.debug(f"Headers: {dict(request.headers)}")
+# Slash command timeframes and usage messages
+METRICS_TIMEFRAMES = {
+    'weekly': ('Weekly', '7 days'),
+    'monthly': ('Monthly', '30 days'),
+    'yearly': ('Yearly', '365 days'),
+}
+# Channel activity periods, in whole UTC days including today
+CHANNEL_PERIODS = {
+    'daily': ('Daily', 1),
+    'weekly': ('Weekly', 7),
+    'monthly': ('Monthly', 30),
+    'yearly': ('Yearly', 365),
+}
+METRICS_USAGE = "Invalid command. Usage: `/metrics [number]`, `/metrics weekly [number]`, `/metrics monthly [number]`, `/metrics yearly [number]`, `/metrics top_users [number]` or `/metrics channels [daily|weekly|monthly|yearly]` (e.g., `/metrics 5`)"
+
+def parse_metrics_command(command_text):
+    """Returns the parts builder for the /metrics arguments, called as build(session, team_id), or raises ValueError with a usage message."""
+    if not command_text:
+        return partial(metrics_command_parts, header="Top Active Users", timeframe='1 day', limit=5, show_bottom=True)
+    
+    subcommand = command_text[0]
+    if subcommand == 'channels':
+        period = command_text[1] if len(command_text) > 1 else 'weekly'
+        if period not in CHANNEL_PERIODS or len(command_text) > 2:
+            raise ValueError("Invalid period. Usage: `/metrics channels [daily|weekly|monthly|yearly]` (e.g., `/metrics channels weekly`)")
+        label, days = CHANNEL_PERIODS[period]
+        return partial(channels_command_parts, header=f"{label} Channel Activity", days=days)
     
-    if not verify_request():
-        return Response("Invalid request signature", status=401)
+    if subcommand in METRICS_TIMEFRAMES or subcommand == 'top_users':
+        try:
+            limit = int(command_text[1]) if len(command_text) > 1 else 5
+        except ValueError:
+            raise ValueError(f"Invalid number. Usage: `/metrics {subcommand} [number]` (e.g., `/metrics {subcommand} 5`)")
+        if subcommand == 'top_users':
+            return partial(metrics_command_parts, header=f"Top {limit} Active Users", timeframe='1 day', limit=limit, show_bottom=False)
+        label, timeframe = METRICS_TIMEFRAMES[subcommand]
+        return partial(metrics_command_parts, header=f"{label} Metrics Report (Top {limit} Active Users)",
+                       timeframe=timeframe, limit=limit, show_bottom=True)
+    
+    try:
+        limit = int(subcommand)
+    except ValueError:
+        raise ValueError(METRICS_USAGE)
+    return partial(metrics_command_parts, header="Top Active Users", timeframe='1 day', limit=limit, show_bottom=True)
+
+def ephemeral_response(message):
+    return jsonify({'response_type': 'ephemeral', 'text': message})
+
+@stats.timed('slack_api_duration_seconds', method='response_url')
+def send_to_response_url(response_url, **kwargs):
+    return WebhookClient(response_url, ssl=slack_clients.ssl_context).send(**kwargs)
+
+def deliver_command_response(team_id, channel_id, response_url, messages):
+    """Posts slash command result messages.
+
+    A single message goes through the command's response_url. Longer results,
+    or commands without one, are posted to the channel with the follow-ups
+    threaded under the first message.
+    """
+    messages = iter(messages)
+    first = next(messages)
+    second = next(messages, None)
+    if response_url and second is None:
+        blocks, text = first
+        response = send_to_response_url(response_url, response_type='in_channel', blocks=blocks, text=text)
+        if response.status_code != 200:
+            raise RuntimeError(f"response_url returned {response.status_code}: {response.body}")
+        return
     
+    remaining = chain([first], [second] if second is not None else [], messages)
+    post_thread(slack_clients.client_for(team_id), channel_id, remaining, limiter=report_limiter, limiter_key=team_id)
+
+def report_command_error(response_url, message):
+    if not response_url:
+        return
+    try:
+        send_to_response_url(response_url, response_type='ephemeral', text=message)
+    except Exception as e:
+        logger.error(f"Failed to report command error: {str(e)}")
+
+def metrics_command_parts(session, team_id, header, timeframe, limit, show_bottom):
+    """(header, metrics) parts of a /metrics result, for render_report()."""
+    parts = [(header, get_cached_user_metrics(session, team_id, limit=limit, timeframe=timeframe))]
+    if show_bottom:
+        bottom = get_cached_user_metrics(session, team_id, limit=limit, timeframe=timeframe, order='bottom')
+        parts.append((f"Bottom {limit} Active Users", bottom))
+    return parts
+
+def channels_command_parts(session, team_id, header, days):
+    """(header, activity, channel_line) part of a /metrics channels result: distinct active users
+    across the workspace and per channel over the last `days` UTC days."""
+    total, channels = channel_activity(session, team_id, day_bucket(utcnow()) - timedelta(days=days - 1))
+    if not channels:
+        return [(header, [], channel_line)]
+    activity = [{'channel_id': None, 'active_users': total}]
+    activity.extend({'channel_id': channel_id, 'active_users': users} for channel_id, users in channels)
+    return [(header, activity, channel_line)]
+
+def run_metrics_command(team_id, channel_id, response_url, build_parts):
+    try:
+        with Session() as session:
+            parts = build_parts(session, team_id)
+        deliver_command_response(team_id, channel_id, response_url, render_report(parts))
+        logger.info(f"Posted metrics report to team {team_id}, channel {channel_id}")
+    except Exception as e:
+        logger.error(f"Failed to post metrics report: {str(e)}")
+        report_command_error(response_url, f"Error posting metrics: {str(e)}")
+
+@app.route('/slack/metrics', methods=['POST'])
+def metrics():
     team_id = request.form.get('team_id')
     channel_id = request.form.get('channel_id')
+    response_url = request.form.get('response_url')
     command_text = request.form.get('text', '').strip().split()
     
-    with Session() as session:
-        if not command_text:
-            metrics = get_user_metrics(session, team_id, limit=5)
-            blocks, text = format_slack_message(metrics, show_bottom=True, limit=5)
-        elif command_text[0] == 'weekly':
-            try:
-                limit = int(command_text[1]) if len(command_text) > 1 else 5
-                metrics = get_user_metrics(session, team_id, limit=limit, timeframe='7 days')
-                blocks, text = format_slack_message(metrics, header=f"Weekly Metrics Report (Top {limit} Active Users)", show_bottom=True, limit=limit)
-            except ValueError:
-                slack_client.chat_postMessage(
-                    channel=channel_id,
-                    text="Invalid number. Usage: `/metrics weekly [number]` (e.g., `/metrics weekly 5`)",
-                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": "Invalid number. Usage: `/metrics weekly [number]` (e.g., `/metrics weekly 5`)"}}]
-                )
-                logger.warning(f"Invalid weekly command received: {command_text}")
-                return Response(status=200)
-        elif command_text[0] == 'monthly':
-            try:
-                limit = int(command_text[1]) if len(command_text) > 1 else 5
-                metrics = get_user_metrics(session, team_id, limit=limit, timeframe='30 days')
-                blocks, text = format_slack_message(metrics, header=f"Monthly Metrics Report (Top {limit} Active Users)", show_bottom=True, limit=limit)
-            except ValueError:
-                slack_client.chat_postMessage(
-                    channel=channel_id,
-                    text="Invalid number. Usage: `/metrics monthly [number]` (e.g., `/metrics monthly 5`)",
-                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": "Invalid number. Usage: `/metrics monthly [number]` (e.g., `/metrics monthly 5`)"}}]
-                )
-                logger.warning(f"Invalid monthly command received: {command_text}")
-                return Response(status=200)
-        elif command_text[0] == 'yearly':
-            try:
-                limit = int(command_text[1]) if len(command_text) > 1 else 5
-                metrics = get_user_metrics(session, team_id, limit=limit, timeframe='365 days')
-                blocks, text = format_slack_message(metrics, header=f"Yearly Metrics Report (Top {limit} Active Users)", show_bottom=True, limit=limit)
-            except ValueError:
-                slack_client.chat_postMessage(
-                    channel=channel_id,
-                    text="Invalid number. Usage: `/metrics yearly [number]` (e.g., `/metrics yearly 5`)",
-                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": "Invalid number. Usage: `/metrics yearly [number]` (e.g., `/metrics yearly 5`)"}}]
-                )
-                logger.warning(f"Invalid yearly command received: {command_text}")
-                return Response(status=200)
-        elif command_text[0] == 'top_users':
-            try:
-                limit = int(command_text[1]) if len(command_text) > 1 else 5
-                metrics = get_user_metrics(session, team_id, limit=limit)
-                blocks, text = format_slack_message(metrics, header=f"Top {limit} Active Users")
-            except ValueError:
-                slack_client.chat_postMessage(
-                    channel=channel_id,
-                    text="Invalid number. Usage: `/metrics top_users [number]` (e.g., `/metrics top_users 5`)",
-                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": "Invalid number. Usage: `/metrics top_users [number]` (e.g., `/metrics top_users 5`)"}}]
-                )
-                logger.warning(f"Invalid top_users command received: {command_text}")
-                return Response(status=200)
-        else:
-            try:
-                limit = int(command_text[0])
-                metrics = get_user_metrics(session, team_id, limit=limit)
-                blocks, text = format_slack_message(metrics, show_bottom=True, limit=limit)
-            except ValueError:
-                slack_client.chat_postMessage(
-                    channel=channel_id,
-                    text="Invalid command. Usage: `/metrics [number]`, `/metrics weekly [number]`, `/metrics monthly [number]`, `/metrics yearly [number]`, or `/metrics top_users [number]` (e.g., `/metrics 5`)",
-                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": "Invalid command. Usage: `/metrics [number]`, `/metrics weekly [number]`, `/metrics monthly [number]`, `/metrics yearly [number]`, or `/metrics top_users [number]` (e.g., `/metrics 5`)"}}]
-                )
-                logger.warning(f"Invalid command received: {command_text}")
-                return Response(status=200)
-        
-        try:
-            slack_client.chat_postMessage(channel=channel_id, blocks=blocks, text=text)
-            logger.info(f"Posted metrics report to team {team_id}, channel {channel_id}")
-        except Exception as e:
-            logger.error(f"Failed to post metrics report: {str(e)}")
-            return Response(f"Error posting metrics: {str(e)}", status=500)
+    try:
+        build_parts = parse_metrics_command(command_text)
+    except ValueError as e:
+        logger.warning(f"Invalid command received: {command_text}")
+        return ephemeral_response(str(e))
+    
+    # The query and delivery run off the request thread; Slack only needs an acknowledgement
+    command_executor.submit(run_metrics_command, team_id, channel_id, response_url, build_parts)
+    return ephemeral_response("Computing metrics…")
+
+def save_report_channel(session, team_id, channel_id):
+    session.execute(
+        text("INSERT INTO report_channels (team_id, channel_id, created_at) VALUES (:team_id, :channel_id, NOW()) ON CONFLICT (team_id) DO UPDATE SET channel_id = :channel_id, created_at = NOW()"),
+        {'team_id': team_id, 'channel_id': channel_id}
+    )
+    session.commit()
+
+def report_channel_message(channel_name):
+    return f"Weekly reports will now be posted to #{channel_name}."
+
+def run_set_report_channel(team_id, channel_id, channel_name, response_url):
+    try:
+        with Session() as session:
+            save_report_channel(session, team_id, channel_id)
         
-        return Response(status=200)
+        message = report_channel_message(channel_name)
+        deliver_command_response(team_id, channel_id, response_url, [([section(message)], message)])
+        logger.info(f"Set report channel for team {team_id} to {channel_id} (#{channel_name})")
+    except Exception as e:
+        logger.error(f"Failed to set report channel: {str(e)}")
+        report_command_error(response_url, f"Error setting report channel: {str(e)}")
 
 @app.route('/slack/set-report-channel', methods=['POST'])
 def set_report_channel():
-    logger.debug(f"Set-report-channel request received: {request.form}")
-    logger.debug(f"Headers: {dict(request.headers)}")
-    
-    if not verify_request():
-        return Response("Invalid request signature", status=401)
-    
     team_id = request.form.get('team_id')
     channel_id = request.form.get('channel_id')
     channel_name = request.form.get('channel_name')
+    response_url = request.form.get('response_url')
+    
+    command_executor.submit(run_set_report_channel, team_id, channel_id, channel_name, response_url)
+    return ephemeral_response(f"Setting #{channel_name} as the report channel…")
+
+# Scheduled jobs: function taking the firing's run key, and trigger
+SCHEDULED_JOBS = {
+    'weekly_report': (send_weekly_report, CronTrigger(day_of_week='mon', hour=9, minute=0, timezone='Asia/Kolkata')),
+    'monthly_report': (send_monthly_report, CronTrigger(day='1', hour=9, minute=0, timezone='Asia/Kolkata')),
+    'yearly_report': (send_yearly_report, CronTrigger(day='1', month='1', hour=9, minute=0, timezone='Asia/Kolkata')),
+    'metrics_rollup': (rollup_metrics, CronTrigger(minute=5, timezone='Asia/Kolkata')),
+    'metrics_maintenance': (maintain_metrics, CronTrigger(hour=3, minute=30, timezone='Asia/Kolkata')),
+    'event_dedupe_expiry': (expire_seen_events, CronTrigger(minute=35, timezone='Asia/Kolkata')),
+}
+CATCHUP_JOBS = ('weekly_report', 'monthly_report', 'yearly_report')
+
+def run_scheduled_job(job_id):
+    """Runs the latest firing of `job_id` unless another process already ran or is running it."""
+    func, trigger = SCHEDULED_JOBS[job_id]
+    lookback = max(timedelta(seconds=SCHEDULER_MISFIRE_GRACE), timedelta(hours=SCHEDULER_CATCHUP_HOURS))
+    fire_time = previous_fire_time(trigger, datetime.now(SCHEDULER_TIMEZONE), lookback)
+    if fire_time is None:
+        logger.debug(f"No recent firing of {job_id} to run")
+        return
     
+    run_key = fire_time.isoformat()
     with Session() as session:
-        session.execute(
-            text("INSERT INTO report_channels (team_id, channel_id, created_at) VALUES (:team_id, :channel_id, NOW()) ON CONFLICT (team_id) DO UPDATE SET channel_id = :channel_id, created_at = NOW()"),
-            {'team_id': team_id, 'channel_id': channel_id}
-        )
-        session.commit()
+        if not acquire_job_run(session, job_id, run_key, SCHEDULER_LEASE_SECONDS):
+            logger.info(f"Skipping {job_id} firing {run_key}: already run or running elsewhere")
+            return
     
+    succeeded = False
     try:
-        slack_client.chat_postMessage(
-            channel=channel_id,
-            text=f"Weekly reports will now be posted to #{channel_name}.",
-            blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": f"Weekly reports will now be posted to #{channel_name}."}}]
-        )
-        logger.info(f"Set report channel for team {team_id} to {channel_id} (#{channel_name})")
-    except Exception as e:
-        logger.error(f"Failed to post channel confirmation: {str(e)}")
-        return Response(f"Error setting report channel: {str(e)}", status=500)
-    
-    return Response(status=200)
+        summary = func(run_key)
+        # A report with failed teams stays unfinished, so catch-up retries just those teams
+        succeeded = not (summary and summary.get('failed'))
+    finally:
+        with Session() as session:
+            finish_job_run(session, job_id, run_key, succeeded)
 
-# Schedule reports
-scheduler.add_job(
-    send_weekly_report,
-    trigger=CronTrigger(day_of_week='mon', hour=9, minute=0, timezone='Asia/Kolkata'),
-    id='weekly_report'
-)
-scheduler.add_job(
-    send_monthly_report,
-    trigger=CronTrigger(day='1', hour=9, minute=0, timezone='Asia/Kolkata'),
-    id='monthly_report'
-)
-scheduler.add_job(
-    send_yearly_report,
-    trigger=CronTrigger(day='1', month='1', hour=9, minute=0, timezone='Asia/Kolkata'),
-    id='yearly_report'
-)
+def catch_up_missed_runs():
+    # A replaced job's next run time is recomputed from now, so firings missed while
+    # no instance was running are found here instead
+    for job_id in CATCHUP_JOBS:
+        try:
+            run_scheduled_job(job_id)
+        except Exception as e:
+            logger.error(f"Catch-up of {job_id} failed: {e}")
+
+def start_scheduler():
+    """Starts the job scheduler in this process if SCHEDULER_ENABLED is true.
+
+    Call it after any fork. Enable the flag on one designated process or
+    instance; each job firing still runs only once if more opt in.
+    """
+    global scheduler
+    create_app()
+    if not env_flag('SCHEDULER_ENABLED', 'false') or scheduler is not None:
+        return scheduler
+    
+    scheduler = build_scheduler(SCHEDULER_MODE, database.engine, SCHEDULER_TIMEZONE, SCHEDULER_MISFIRE_GRACE)
+    # Jobs in the shared store are stored by reference, which must resolve in every instance
+    for job_id, (func, trigger) in SCHEDULED_JOBS.items():
+        scheduler.add_job(
+            'app:run_scheduled_job' if SCHEDULER_MODE == 'cluster' else run_scheduled_job,
+            trigger=trigger,
+            args=[job_id],
+            id=job_id,
+            replace_existing=True
+        )
+    if SCHEDULER_CATCHUP_HOURS > 0:
+        scheduler.add_job(catch_up_missed_runs, id='catch_up', jobstore=LOCAL_JOBSTORE)
+    scheduler.start()
+    logger.info(f"Started {SCHEDULER_MODE} scheduler in process {os.getpid()}")
+    return scheduler
 
 if __name__ == '__main__':
+    create_app()
+    start_scheduler()
     app.run(debug=True)
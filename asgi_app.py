@@ -0,0 +1,338 @@
+"""ASGI entry point serving the Slack routes with async Slack and database clients.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+
+Serves /slack/events, /slack/metrics, /slack/set-report-channel and the
+OAuth routes with the same behaviour and admission checks as app.py, but
+Slack Web API calls go through AsyncWebClient and queries through an
+asyncpg engine, so a request waiting on Slack or the database holds
+neither a thread nor, between queries, a connection. Event counting, the leaderboard cache, report
+rendering and the scheduler are app.py's own, set up by create_app() at
+startup. Needs the packages in requirements-async.txt.
+"""
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from itertools import chain
+
+from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.webhook.async_client import AsyncWebhookClient
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Match, Route
+
+import app as bot
+from instrumentation import stats
+from report_render import render_report, section
+from slack_clients import SlackClientRegistry, TOKENS_QUERY
+from slack_delivery import post_thread_async
+
+logger = logging.getLogger(__name__)
+
+# Built at startup, once create_app() has read the configuration
+slack_clients = None
+
+
+class InstrumentedAsyncWebClient(AsyncWebClient):
+    """AsyncWebClient that records the latency of every Web API call by method."""
+
+    async def api_call(self, api_method, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await super().api_call(api_method, **kwargs)
+            outcome = 'ok'
+            return response
+        finally:
+            stats.observe('slack_api_duration_seconds', time.perf_counter() - started, method=api_method, outcome=outcome)
+
+
+class AsyncSlackClientRegistry(SlackClientRegistry):
+    """SlackClientRegistry of AsyncWebClients whose tokens are loaded through an AsyncSession factory."""
+
+    client_class = InstrumentedAsyncWebClient
+
+    async def client_for(self, team_id):
+        entry = self._cached(team_id)
+        if entry is None:
+            tokens = await self._load_tokens_async([team_id])
+            entry = self._store(team_id, tokens.get(team_id))
+        client = entry[1]
+        return client if client is not None else self.default_client
+
+    async def _load_tokens_async(self, team_ids):
+        async with self.session_factory() as session:
+            rows = (await session.execute(TOKENS_QUERY, {'team_ids': list(team_ids)})).fetchall()
+        logger.debug(f"Loaded bot tokens for {len(rows)} of {len(team_ids)} teams")
+        return dict(rows)
+
+
+def route_template(scope):
+    """The path of the route matching `scope`, or 'unmatched', so unknown URLs cannot add label values."""
+    for route in scope['app'].routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return 'unmatched'
+
+
+class RequestTimer:
+    """ASGI middleware recording request latency like instrument_flask(), up to the response start."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                stats.observe(
+                    'http_request_duration_seconds',
+                    time.perf_counter() - started,
+                    route=route_template(scope),
+                    method=scope['method'],
+                    status=message['status']
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_timed)
+
+
+class AdmissionMiddleware:
+    """Runs app.admission on the raw body of every Slack request, like app.py's before_request hook."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not bot.admission.guards(scope['method'], scope['path']):
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        content_length = headers.get('content-length')
+        rejection = bot.admission.oversized(int(content_length) if content_length and content_length.isdigit() else None)
+        body = b''
+        if rejection is None:
+            more_body = True
+            while more_body and len(body) <= bot.admission.max_body_bytes:
+                message = await receive()
+                body += message.get('body', b'')
+                more_body = message.get('more_body', False)
+            rejection = bot.admission.check(scope['path'], headers, body, headers.get('content-type'))
+        if rejection is not None:
+            response = Response(rejection.body, status_code=rejection.status, headers=rejection.headers)
+            return await response(scope, receive, send)
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            bot.admission.release()
+
+
+def ephemeral_response(message, background=None):
+    return JSONResponse({'response_type': 'ephemeral', 'text': message}, background=background)
+
+
+async def send_to_response_url(response_url, **kwargs):
+    started = time.perf_counter()
+    try:
+        return await AsyncWebhookClient(response_url, ssl=slack_clients.ssl_context).send(**kwargs)
+    finally:
+        stats.observe('slack_api_duration_seconds', time.perf_counter() - started, method='response_url')
+
+
+async def deliver_command_response(team_id, channel_id, response_url, messages):
+    """app.deliver_command_response() through the async clients."""
+    messages = iter(messages)
+    first = next(messages)
+    second = next(messages, None)
+    if response_url and second is None:
+        blocks, text = first
+        response = await send_to_response_url(response_url, response_type='in_channel', blocks=blocks, text=text)
+        if response.status_code != 200:
+            raise RuntimeError(f"response_url returned {response.status_code}: {response.body}")
+        return
+
+    remaining = chain([first], [second] if second is not None else [], messages)
+    client = await slack_clients.client_for(team_id)
+    await post_thread_async(client, channel_id, remaining, limiter=bot.report_limiter, limiter_key=team_id)
+
+
+async def report_command_error(response_url, message):
+    if not response_url:
+        return
+    try:
+        await send_to_response_url(response_url, response_type='ephemeral', text=message)
+    except Exception as e:
+        logger.error(f"Failed to report command error: {str(e)}")
+
+
+async def slack_events(request):
+    payload = json.loads(await request.body())
+    if payload.get('type') == 'url_verification':
+        return PlainTextResponse(payload['challenge'])
+
+    event_id = payload.get('event_id')
+    retry_num = request.headers.get('X-Slack-Retry-Num')
+    if event_id:
+        # Only a retry can query the shared dedupe store, so only a retry runs off the event loop
+        if retry_num:
+            first_delivery = await run_in_threadpool(bot.seen_events.add, event_id, retry=True)
+        else:
+            first_delivery = bot.seen_events.add(event_id)
+        if not first_delivery:
+            logger.info(f"Dropping duplicate delivery of event {event_id} (retry {retry_num})")
+            return Response(status_code=200)
+
+    try:
+        # Events only touch the in-memory buffer, unless it writes every event through
+        if bot.metrics_buffer.max_staleness <= 0:
+            await run_in_threadpool(bot.process_event, payload)
+        else:
+            bot.process_event(payload)
+    except Exception:
+        if event_id:
+            await run_in_threadpool(bot.seen_events.discard, event_id)
+        raise
+
+    return Response(status_code=200)
+
+
+async def run_metrics_command(team_id, channel_id, response_url, build_parts):
+    try:
+        async with bot.database.async_session() as session:
+            parts = await session.run_sync(build_parts, team_id)
+        await deliver_command_response(team_id, channel_id, response_url, render_report(parts))
+        logger.info(f"Posted metrics report to team {team_id}, channel {channel_id}")
+    except Exception as e:
+        logger.error(f"Failed to post metrics report: {str(e)}")
+        await report_command_error(response_url, f"Error posting metrics: {str(e)}")
+
+
+async def metrics(request):
+    form = await request.form()
+
+    team_id = form.get('team_id')
+    channel_id = form.get('channel_id')
+    response_url = form.get('response_url')
+    command_text = form.get('text', '').strip().split()
+
+    try:
+        build_parts = bot.parse_metrics_command(command_text)
+    except ValueError as e:
+        logger.warning(f"Invalid command received: {command_text}")
+        return ephemeral_response(str(e))
+
+    # Runs once the acknowledgement has been sent
+    task = BackgroundTask(run_metrics_command, team_id, channel_id, response_url, build_parts)
+    return ephemeral_response("Computing metrics…", background=task)
+
+
+async def run_set_report_channel(team_id, channel_id, channel_name, response_url):
+    try:
+        async with bot.database.async_session() as session:
+            await session.run_sync(bot.save_report_channel, team_id, channel_id)
+
+        message = bot.report_channel_message(channel_name)
+        await deliver_command_response(team_id, channel_id, response_url, [([section(message)], message)])
+        logger.info(f"Set report channel for team {team_id} to {channel_id} (#{channel_name})")
+    except Exception as e:
+        logger.error(f"Failed to set report channel: {str(e)}")
+        await report_command_error(response_url, f"Error setting report channel: {str(e)}")
+
+
+async def set_report_channel(request):
+    form = await request.form()
+
+    team_id = form.get('team_id')
+    channel_id = form.get('channel_id')
+    channel_name = form.get('channel_name')
+    response_url = form.get('response_url')
+
+    task = BackgroundTask(run_set_report_channel, team_id, channel_id, channel_name, response_url)
+    return ephemeral_response(f"Setting #{channel_name} as the report channel…", background=task)
+
+
+async def install(request):
+    return HTMLResponse(bot.install_link())
+
+
+async def oauth_redirect(request):
+    try:
+        response = await slack_clients.default_client.oauth_v2_access(
+            client_id=os.getenv('SLACK_CLIENT_ID'),
+            client_secret=os.getenv('SLACK_CLIENT_SECRET'),
+            code=request.query_params.get('code')
+        )
+        if not response['ok']:
+            return HTMLResponse(f"Error installing app: {response['error']}")
+
+        team_id = response['team']['id']
+        async with bot.database.async_session() as session:
+            await session.run_sync(bot.save_bot_token, team_id, response['access_token'])
+        slack_clients.invalidate(team_id)
+        # The scheduler posts reports through app.py's registry
+        bot.slack_clients.invalidate(team_id)
+        if bot.BACKFILL_ON_INSTALL:
+            bot.backfill_executor.submit(bot.run_backfill, team_id)
+        return HTMLResponse("App installed successfully!")
+    except Exception as e:
+        logger.error(f"Error during OAuth: {str(e)}")
+        return HTMLResponse(f"Error during OAuth: {str(e)}")
+
+
+async def internal_stats(request):
+    denied = bot.internal_denied(request.headers.get('Authorization'))
+    if denied:
+        return PlainTextResponse(denied[0], status_code=denied[1])
+    return PlainTextResponse(stats.render(), media_type='text/plain; version=0.0.4')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global slack_clients
+    bot.create_app()
+    slack_clients = AsyncSlackClientRegistry(
+        bot.database.async_session,
+        default_token=os.getenv('SLACK_BOT_TOKEN'),
+        base_url=os.getenv('SLACK_API_URL', WebClient.BASE_URL),
+        ttl=float(os.getenv('SLACK_TOKEN_CACHE_TTL', '3600')),
+        max_size=int(os.getenv('SLACK_TOKEN_CACHE_SIZE', '1000'))
+    )
+    bot.start_scheduler()
+    yield
+    bot.metrics_buffer.close()
+    await bot.database.async_engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/slack/events', slack_events, methods=['POST']),
+        Route('/slack/metrics', metrics, methods=['POST']),
+        Route('/slack/set-report-channel', set_report_channel, methods=['POST']),
+        Route('/slack/install', install, methods=['GET']),
+        Route('/slack/oauth_redirect', oauth_redirect, methods=['GET']),
+        Route('/internal/stats', internal_stats, methods=['GET']),
+    ],
+    middleware=[Middleware(RequestTimer), Middleware(AdmissionMiddleware)],
+    lifespan=lifespan
+)
@@ -0,0 +1,314 @@
+"""Backfills a team's message, reaction and response-time history from Slack.
+
+    python backfill.py T0123456 --days 90
+
+Pages through conversations.list, conversations.history and
+conversations.replies with the team's bot token. Each page of history is
+aggregated in memory and added to the hourly metric tables in the same
+transaction that advances the channel's checkpoint in backfill_progress, so
+an interrupted backfill resumes from its last written page without
+counting anything twice. History stops at the team's install time, where
+the live event stream takes over.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from slack_sdk.errors import SlackApiError
+from sqlalchemy import text
+
+from metrics_buffer import add_counts, write_counts
+from metrics_store import hour_bucket
+from slack_delivery import RateLimiter, call_with_retry
+
+logger = logging.getLogger(__name__)
+
+# Slack rate-limit tier of each method used
+METHOD_TIERS = {
+    'conversations.list': 2,
+    'conversations.history': 3,
+    'conversations.replies': 3,
+}
+# Channels that no longer exist are recorded as finished rather than retried. Other errors,
+# such as missing_scope, leave the checkpoint unfinished so a later run reads the channel.
+SKIPPED_CHANNEL_ERRORS = {'channel_not_found'}
+
+
+def tier_limiters(tier2_per_minute, tier3_per_minute):
+    return {
+        2: RateLimiter(rate=tier2_per_minute / 60, burst=1),
+        3: RateLimiter(rate=tier3_per_minute / 60, burst=1),
+    }
+
+
+def install_time(session, team_id):
+    """Epoch seconds at which `team_id` installed the app, or None if it has no stored token."""
+    installed = session.execute(
+        text("SELECT created_at FROM slack_bots WHERE team_id = :team_id"), {'team_id': team_id}
+    ).scalar()
+    if installed is None:
+        return None
+    if isinstance(installed, str):
+        installed = datetime.fromisoformat(installed)
+    return installed.replace(tzinfo=timezone.utc).timestamp()
+
+
+class Backfill:
+    """Backfills one team's public channels between `oldest` and `latest` (epoch seconds).
+
+    Channels are read by `workers` threads; every Web API call first takes a
+    token from the limiter of its method's tier, keyed by team, so the rate
+    stays within Slack's per-workspace limits however many threads run.
+    """
+
+    def __init__(self, session_factory, client, team_id, oldest, latest, limiters, workers=4, page_size=200, bot_user_id=None):
+        self.session_factory = session_factory
+        self.client = client
+        self.team_id = team_id
+        self.oldest = oldest
+        self.latest = latest
+        self.limiters = limiters
+        self.workers = workers
+        self.page_size = page_size
+        self.bot_user_id = bot_user_id
+
+    def call(self, method, **kwargs):
+        return call_with_retry(
+            getattr(self.client, method.replace('.', '_')),
+            limiter=self.limiters[METHOD_TIERS[method]],
+            limiter_key=self.team_id,
+            attempts=5,
+            **kwargs
+        )
+
+    def list_channels(self):
+        """Returns (member channel ids, number of channels the bot is not a member of)."""
+        channels = []
+        not_member = 0
+        cursor = None
+        while True:
+            response = self.call(
+                'conversations.list',
+                types='public_channel',
+                exclude_archived=True,
+                limit=self.page_size,
+                cursor=cursor
+            )
+            # Channels the bot has not joined get no checkpoint, so a later run picks them up once it is invited
+            for channel in response['channels']:
+                if channel.get('is_member'):
+                    channels.append(channel['id'])
+                else:
+                    not_member += 1
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return channels, not_member
+
+    def run(self):
+        started = time.perf_counter()
+        channels, not_member = self.list_channels()
+        pending = self.start_channels(channels)
+        logger.info(f"Backfilling {len(pending)} of {len(channels)} channels for team {self.team_id}, "
+                    f"skipping {not_member} the bot is not a member of")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as executor:
+            results = list(executor.map(self.backfill_channel, pending))
+
+        failures = [result for result in results if 'error' in result]
+        skipped = sum(1 for result in results if 'skipped' in result)
+        summary = {
+            'team_id': self.team_id,
+            'channels': len(channels),
+            'not_member': not_member,
+            'already_finished': len(channels) - len(pending),
+            'backfilled': len(results) - len(failures) - skipped,
+            'skipped': skipped,
+            'messages': sum(result.get('messages', 0) for result in results),
+            'replies': sum(result.get('replies', 0) for result in results),
+            'reactions': sum(result.get('reactions', 0) for result in results),
+            'failed': failures,
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+        logger.info(f"Finished backfill: {summary}")
+        return summary
+
+    def start_channels(self, channels):
+        """Creates checkpoints for new channels; returns (channel_id, oldest, latest, cursor) for every unfinished one."""
+        now = datetime.utcnow()
+        with self.session_factory() as session:
+            if channels:
+                session.execute(text("""
+                    INSERT INTO backfill_progress (team_id, channel_id, oldest, latest, updated_at)
+                    VALUES (:team_id, :channel_id, :oldest, :latest, :now)
+                    ON CONFLICT (team_id, channel_id) DO NOTHING
+                """), [
+                    {
+                        'team_id': self.team_id,
+                        'channel_id': channel_id,
+                        'oldest': f"{self.oldest:.6f}",
+                        'latest': f"{self.latest:.6f}",
+                        'now': now
+                    }
+                    for channel_id in channels
+                ])
+                session.commit()
+            rows = session.execute(text("""
+                SELECT channel_id, oldest, latest, next_cursor FROM backfill_progress
+                WHERE team_id = :team_id AND finished_at IS NULL
+            """), {'team_id': self.team_id}).fetchall()
+        wanted = set(channels)
+        return [tuple(row) for row in rows if row[0] in wanted]
+
+    def backfill_channel(self, progress):
+        # A resumed channel keeps the window it started with
+        channel_id, oldest, latest, cursor = progress
+        totals = {'channel_id': channel_id, 'messages': 0, 'replies': 0, 'reactions': 0}
+        try:
+            while True:
+                response = self.call(
+                    'conversations.history',
+                    channel=channel_id,
+                    oldest=oldest,
+                    latest=latest,
+                    inclusive=False,
+                    limit=self.page_size,
+                    cursor=cursor
+                )
+                counts, bins, active = {}, {}, {}
+                page = {'messages': 0, 'replies': 0, 'reactions': 0}
+                for message in response['messages']:
+                    self.add_message(counts, bins, active, page, channel_id, message)
+                    if message.get('reply_count') and message.get('thread_ts') == message['ts']:
+                        for reply in self.thread_replies(channel_id, message['ts'], latest):
+                            self.add_message(counts, bins, active, page, channel_id, reply, parent_ts=float(message['ts']))
+
+                cursor = response.get('response_metadata', {}).get('next_cursor') or None
+                self.save_page(channel_id, counts, bins, active, cursor, page['messages'] + page['replies'])
+                for key, value in page.items():
+                    totals[key] += value
+                if cursor is None:
+                    return totals
+        except SlackApiError as e:
+            error = e.response.get('error')
+            if error in SKIPPED_CHANNEL_ERRORS:
+                logger.info(f"Skipping channel {channel_id} of team {self.team_id}: {error}")
+                self.save_page(channel_id, {}, {}, {}, None, 0)
+                return totals
+            if error == 'not_in_channel':
+                # Left unfinished, so it is read once the bot is invited back
+                logger.info(f"Skipping channel {channel_id} of team {self.team_id} until the bot is a member")
+                totals['skipped'] = error
+                return totals
+            logger.error(f"Backfill of channel {channel_id} for team {self.team_id} failed: {error}")
+            totals['error'] = error
+            return totals
+        except Exception as e:
+            logger.error(f"Backfill of channel {channel_id} for team {self.team_id} failed: {e}")
+            totals['error'] = str(e)
+            return totals
+
+    def thread_replies(self, channel_id, thread_ts, latest):
+        cursor = None
+        while True:
+            response = self.call(
+                'conversations.replies',
+                channel=channel_id,
+                ts=thread_ts,
+                latest=latest,
+                inclusive=False,
+                limit=self.page_size,
+                cursor=cursor
+            )
+            for reply in response['messages']:
+                # The parent is repeated at the top of every page
+                if reply['ts'] != thread_ts:
+                    yield reply
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+
+    def add_message(self, counts, bins, active, page, channel_id, message, parent_ts=None):
+        ts = float(message['ts'])
+        bucket_start = hour_bucket(ts)
+
+        # Counted like the live event path: no bot messages, edits or other subtypes
+        if 'subtype' not in message and 'bot_id' not in message and message.get('user'):
+            response_time = ts - parent_ts if parent_ts is not None else None
+            add_counts(counts, bins, self.team_id, bucket_start, message['user'], channel_id, 1, 0, response_time, active)
+            page['replies' if parent_ts is not None else 'messages'] += 1
+
+        # Reactions on any message count, as reaction_added events do. Their
+        # times are not returned, so they count in the hour of the message.
+        for reaction in message.get('reactions', []):
+            for user_id in reaction.get('users', []):
+                if user_id == self.bot_user_id:
+                    continue
+                add_counts(counts, bins, self.team_id, bucket_start, user_id, channel_id, 0, 1, None, active)
+                page['reactions'] += 1
+
+    def save_page(self, channel_id, counts, bins, active, cursor, messages):
+        with self.session_factory() as session:
+            write_counts(session, counts, bins, active)
+            session.execute(text("""
+                UPDATE backfill_progress SET
+                    next_cursor = :cursor,
+                    messages = messages + :messages,
+                    finished_at = :finished_at,
+                    updated_at = :now
+                WHERE team_id = :team_id AND channel_id = :channel_id
+            """), {
+                'cursor': cursor,
+                'messages': messages,
+                'finished_at': datetime.utcnow() if cursor is None else None,
+                'now': datetime.utcnow(),
+                'team_id': self.team_id,
+                'channel_id': channel_id
+            })
+            session.commit()
+
+
+def backfill_team(session_factory, client, team_id, days=90, latest=None, workers=4,
+                  tier2_per_minute=20, tier3_per_minute=50, bot_user_id=None):
+    """Backfills the `days` before `latest` (the team's install time by default) and returns a summary."""
+    if latest is None:
+        with session_factory() as session:
+            latest = install_time(session, team_id)
+        if latest is None:
+            latest = time.time()
+            logger.warning(f"Team {team_id} has no install time, backfilling up to now")
+    oldest = latest - days * 86400
+    backfill = Backfill(
+        session_factory, client, team_id, oldest, latest,
+        limiters=tier_limiters(tier2_per_minute, tier3_per_minute),
+        workers=workers,
+        bot_user_id=bot_user_id
+    )
+    return backfill.run()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('team_ids', nargs='+', help="Teams to backfill, using their tokens from slack_bots")
+    parser.add_argument('--days', type=int, default=int(os.getenv('BACKFILL_DAYS', '90')))
+    parser.add_argument('--latest', type=float, help="Backfill up to these epoch seconds instead of the install time")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BACKFILL_WORKERS', '4')), help="Channels read concurrently")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import app as bot
+
+    args = parse_args(argv)
+    bot.create_app()
+    summaries = []
+    for team_id in args.team_ids:
+        summaries.append(bot.run_backfill(team_id, days=args.days, latest=args.latest, workers=args.workers))
+    return 1 if any(summary is None or summary['failed'] for summary in summaries) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
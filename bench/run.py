@@ -0,0 +1,358 @@
+"""Offline load test for the Flask app in app.py.
+
+Runs the app in-process against a SQLite file (or the PostgreSQL database
+given with --database-url) and a stub Slack Web API server, replays a
+synthetic stream of Slack events and /metrics commands, runs a scheduled
+report, optionally backfills a synthetic channel history from the stub
+(--backfill-channels) and prints the results as JSON:
+
+    python -m bench.run --events 20000 --commands 200 --output bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+from slack_sdk.signature import SignatureVerifier
+from sqlalchemy import event, text
+
+from bench.stub_slack import StubSlackServer
+
+SIGNING_SECRET = 'bench-signing-secret'
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'schema.sql')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help="Database to run against (default: a temporary SQLite file). Its tables are dropped and recreated.")
+    parser.add_argument('--sslmode', default='', help="DATABASE_SSLMODE for PostgreSQL (default: unset)")
+    parser.add_argument('--events', type=int, default=5000, help="Slack events to replay")
+    parser.add_argument('--commands', type=int, default=50, help="/metrics commands to send after the events")
+    parser.add_argument('--teams', type=int, default=3)
+    parser.add_argument('--users', type=int, default=200, help="Users per team")
+    parser.add_argument('--channels', type=int, default=10, help="Channels per team")
+    parser.add_argument('--reaction-ratio', type=float, default=0.3, help="Share of events that are reactions")
+    parser.add_argument('--thread-ratio', type=float, default=0.25, help="Share of messages that are threaded replies")
+    parser.add_argument('--span-days', type=float, default=1.0, help="Event timestamps are spread over this many past days")
+    parser.add_argument('--concurrency', type=int, default=4, help="Threads sending requests")
+    parser.add_argument('--ingest-mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--flush-interval', default='5', help="METRICS_FLUSH_INTERVAL for the run")
+    parser.add_argument('--team-rate', default='0', help="ADMISSION_TEAM_RATE for the run (default: unlimited)")
+    parser.add_argument('--report-team-rate', default='1000', help="REPORT_TEAM_RATE for the run")
+    parser.add_argument('--backfill-channels', type=int, default=0, help="Channels of history to backfill for an extra team (default: skip the backfill)")
+    parser.add_argument('--backfill-messages', type=int, default=500, help="Top-level messages per backfilled channel")
+    parser.add_argument('--backfill-rate', default='60000', help="BACKFILL_TIER2/3_PER_MINUTE for the run")
+    parser.add_argument('--slack-latency-ms', type=float, default=0.0, help="Delay added to every stub Slack call")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99),
+        'max': round(ordered[-1] * 1000, 3),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3)
+    }
+
+
+def synthetic_events(args, rng):
+    now = time.time()
+    for i in range(args.events):
+        team = rng.randrange(args.teams)
+        team_id = f"TBENCH{team:03d}"
+        user_id = f"U{team:03d}{rng.randrange(args.users):05d}"
+        channel_id = f"C{team:03d}{rng.randrange(args.channels):04d}"
+        ts = now - rng.random() * args.span_days * 86400
+
+        if rng.random() < args.reaction_ratio:
+            slack_event = {
+                'type': 'reaction_added',
+                'user': user_id,
+                'reaction': 'thumbsup',
+                'item': {'type': 'message', 'channel': channel_id, 'ts': f"{ts - 60:.6f}"},
+                'event_ts': f"{ts:.6f}"
+            }
+        else:
+            slack_event = {'type': 'message', 'user': user_id, 'channel': channel_id, 'text': 'hello', 'ts': f"{ts:.6f}"}
+            if rng.random() < args.thread_ratio:
+                slack_event['thread_ts'] = f"{ts - rng.uniform(1, 3600):.6f}"
+
+        yield {
+            'type': 'event_callback',
+            'team_id': team_id,
+            'api_app_id': 'ABENCH',
+            'event_id': f"Ev{i:010d}",
+            'event_time': int(ts),
+            'event': slack_event
+        }
+
+
+def synthetic_commands(args, rng, stub):
+    variants = ['', '5', '10', 'weekly 5', 'weekly 20', 'monthly 10', 'yearly 5', 'top_users 3', 'channels', 'channels monthly']
+    for i in range(args.commands):
+        team = rng.randrange(args.teams)
+        yield {
+            'team_id': f"TBENCH{team:03d}",
+            'channel_id': f"C{team:03d}0000",
+            'user_id': f"U{team:03d}00000",
+            'command': '/metrics',
+            'text': rng.choice(variants),
+            'response_url': stub.response_url(f"cmd{i}")
+        }
+
+
+def synthetic_history(args, rng, now):
+    """Returns {channel_id: messages} for the stub and the (messages, reactions) a backfill should count."""
+    history = {}
+    expected_messages = expected_reactions = 0
+    for channel in range(args.backfill_channels):
+        messages = []
+        for i in range(args.backfill_messages):
+            ts = now - rng.random() * args.span_days * 86400
+            message = {'type': 'message', 'user': f"UBF{rng.randrange(args.users):05d}", 'text': 'hello', 'ts': f"{ts:.6f}"}
+            if rng.random() < 0.05:
+                # Bot messages are not counted
+                message['bot_id'] = 'BBENCH'
+            else:
+                expected_messages += 1
+            if rng.random() < args.reaction_ratio:
+                users = [f"UBF{rng.randrange(args.users):05d}" for _ in range(rng.randint(1, 3))]
+                message['reactions'] = [{'name': 'thumbsup', 'users': users, 'count': len(users)}]
+                expected_reactions += len(users)
+            if rng.random() < args.thread_ratio:
+                message['replies'] = [
+                    {'type': 'message', 'user': f"UBF{rng.randrange(args.users):05d}", 'text': 'reply', 'ts': f"{min(now - 1, ts + rng.uniform(1, 3600)):.6f}", 'thread_ts': f"{ts:.6f}"}
+                    for _ in range(rng.randint(1, 4))
+                ]
+                expected_messages += len(message['replies'])
+            messages.append(message)
+        history[f"CBF{channel:04d}"] = messages
+    return history, expected_messages, expected_reactions
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+            return count
+
+
+def replay(app, path, requests, concurrency, send):
+    """Sends every request to `path` from `concurrency` threads and returns (latencies, seconds, failures)."""
+    local = threading.local()
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def one(request_data):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        response = send(client, path, request_data)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                failures.append(response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(one, requests):
+            pass
+    return latencies, time.perf_counter() - started, failures
+
+
+def signed_post(client, path, body, content_type):
+    """POSTs `body` with the Slack signature headers the admission checks expect."""
+    timestamp = str(int(time.time()))
+    signature = SignatureVerifier(SIGNING_SECRET).generate_signature(timestamp=timestamp, body=body)
+    return client.post(path, data=body, content_type=content_type, headers={
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': signature
+    })
+
+
+def prepare_database(engine):
+    with open(SCHEMA_PATH) as f:
+        statements = [statement.strip() for statement in f.read().split(';')]
+    with engine.begin() as connection:
+        for statement in statements:
+            lines = [line for line in statement.splitlines() if not line.startswith('--')]
+            if any(line.strip() for line in lines):
+                connection.execute(text("\n".join(lines)))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    stub = StubSlackServer(latency=args.slack_latency_ms / 1000).start()
+    workdir = tempfile.mkdtemp(prefix='slack-bot-bench-')
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    # create_app() reads its configuration from the environment
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'DATABASE_SSLMODE': args.sslmode,
+        'SLACK_API_URL': stub.api_url,
+        'SLACK_BOT_TOKEN': 'xoxb-bench',
+        'SLACK_SIGNING_SECRET': SIGNING_SECRET,
+        'ADMISSION_TEAM_RATE': args.team_rate,
+        'INGEST_MODE': args.ingest_mode,
+        'METRICS_FLUSH_INTERVAL': args.flush_interval,
+        'REPORT_TEAM_RATE': args.report_team_rate,
+        'BACKFILL_TIER2_PER_MINUTE': args.backfill_rate,
+        'BACKFILL_TIER3_PER_MINUTE': args.backfill_rate
+    })
+    import app as bot
+    bot.create_app()
+    logging.getLogger().setLevel(args.log_level)
+    engine = bot.database.engine
+
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def register_now(dbapi_connection, connection_record):
+            dbapi_connection.create_function('NOW', 0, lambda: datetime.utcnow().isoformat(sep=' '))
+    prepare_database(engine)
+    queries = QueryCounter(engine)
+
+    # Events, including the work still buffered or queued when the last response returned
+    events = list(synthetic_events(args, rng))
+    started = time.perf_counter()
+    latencies, send_seconds, failures = replay(
+        bot.app, '/slack/events', events, args.concurrency,
+        lambda client, path, payload: signed_post(client, path, json.dumps(payload), 'application/json')
+    )
+    bot.event_dispatcher.close(timeout=600)
+    bot.metrics_buffer.flush()
+    ingest_seconds = time.perf_counter() - started
+    ingest_queries = queries.reset()
+    ingest = {
+        'events': len(events),
+        'failures': len(failures),
+        'send_seconds': round(send_seconds, 3),
+        'ingest_seconds': round(ingest_seconds, 3),
+        'events_per_sec': round(len(events) / ingest_seconds, 1) if ingest_seconds else None,
+        'route_latency_ms': percentiles(latencies),
+        'db_queries': ingest_queries,
+        'db_queries_per_event': round(ingest_queries / len(events), 4) if events else None,
+        'admission_rejections': {
+            dict(labels)['reason']: count for labels, count in bot.stats.counters('admission_rejections_total').items()
+        }
+    }
+
+    # Slash commands, timed to the acknowledgement and to the last delivered reply
+    commands = list(synthetic_commands(args, rng, stub))
+    started = time.perf_counter()
+    latencies, ack_seconds, failures = replay(
+        bot.app, '/slack/metrics', commands, args.concurrency,
+        lambda client, path, form: signed_post(client, path, urlencode(form), 'application/x-www-form-urlencoded')
+    )
+    bot.command_executor.shutdown(wait=True)
+    command_queries = queries.reset()
+    command_results = {
+        'commands': len(commands),
+        'failures': len(failures),
+        'route_latency_ms': percentiles(latencies),
+        'completed_seconds': round(time.perf_counter() - started, 3),
+        'db_queries': command_queries,
+        'db_queries_per_command': round(command_queries / len(commands), 4) if commands else None,
+        'leaderboard_cache': bot.leaderboard_cache.stats()
+    }
+
+    # One scheduled report across every team
+    calls_before = sum(stub.calls.values())
+    started = time.perf_counter()
+    summary = bot.send_report('weekly')
+    report = {
+        'seconds': round(time.perf_counter() - started, 3),
+        'summary': summary,
+        'db_queries': queries.reset(),
+        'slack_calls': sum(stub.calls.values()) - calls_before
+    }
+
+    # History backfill of one extra team, run twice to check that a finished backfill adds nothing
+    backfill = None
+    if args.backfill_channels:
+        now = time.time()
+        history, expected_messages, expected_reactions = synthetic_history(args, rng, now)
+        for channel_id, messages in history.items():
+            stub.add_history(channel_id, messages)
+        calls_before = sum(stub.calls.values())
+        summary = bot.run_backfill('TBACKFILL', latest=now)
+        slack_calls = sum(stub.calls.values()) - calls_before
+        rerun = bot.run_backfill('TBACKFILL', latest=now)
+        with bot.Session() as session:
+            counted = session.execute(text(
+                "SELECT SUM(message_count), SUM(reaction_count) FROM ("
+                " SELECT message_count, reaction_count FROM metrics_hourly WHERE team_id = 'TBACKFILL'"
+                " UNION ALL SELECT message_count, reaction_count FROM metrics_daily WHERE team_id = 'TBACKFILL') buckets"
+            )).fetchone()
+        backfill = {
+            'summary': summary,
+            'rerun_already_finished': rerun['already_finished'] if rerun else None,
+            'slack_calls': slack_calls,
+            'db_queries': queries.reset(),
+            'expected': {'messages': expected_messages, 'reactions': expected_reactions},
+            'counted': {'messages': int(counted[0] or 0), 'reactions': int(counted[1] or 0)}
+        }
+
+    results = {
+        'commit': git_commit(),
+        'database': engine.dialect.name,
+        'config': {key: value for key, value in vars(args).items() if key not in ('database_url', 'output')},
+        'ingest': ingest,
+        'commands': command_results,
+        'report': report,
+        'backfill': backfill,
+        'slack_calls': dict(stub.calls)
+    }
+    stub.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+-- Tables used by the benchmark, in SQL that both SQLite and PostgreSQL accept.
+-- Mirrors the schema in README.md after all migrations are applied, except
+-- that the daily tables are not partitioned.
+DROP TABLE IF EXISTS metrics_hourly;
+DROP TABLE IF EXISTS metrics_daily;
+DROP TABLE IF EXISTS metrics_monthly;
+DROP TABLE IF EXISTS response_time_bins_hourly;
+DROP TABLE IF EXISTS response_time_bins_daily;
+DROP TABLE IF EXISTS response_time_bins_monthly;
+DROP TABLE IF EXISTS channel_activity_hll;
+DROP TABLE IF EXISTS channel_activity_hll_monthly;
+DROP TABLE IF EXISTS report_channels;
+DROP TABLE IF EXISTS slack_bots;
+DROP TABLE IF EXISTS job_runs;
+DROP TABLE IF EXISTS report_runs;
+DROP TABLE IF EXISTS backfill_progress;
+DROP TABLE IF EXISTS slack_event_ids;
+
+CREATE TABLE metrics_hourly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_hourly_bucket_start_idx ON metrics_hourly (bucket_start);
+
+CREATE TABLE metrics_daily (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_daily_bucket_start_idx ON metrics_daily (bucket_start);
+
+CREATE TABLE metrics_monthly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_monthly_bucket_start_idx ON metrics_monthly (bucket_start);
+
+CREATE TABLE response_time_bins_hourly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_hourly_bucket_start_idx ON response_time_bins_hourly (bucket_start);
+
+CREATE TABLE response_time_bins_daily (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_daily_bucket_start_idx ON response_time_bins_daily (bucket_start);
+
+CREATE TABLE response_time_bins_monthly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_monthly_bucket_start_idx ON response_time_bins_monthly (bucket_start);
+
+CREATE TABLE channel_activity_hll (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    channel_id TEXT NOT NULL,
+    registers BYTEA NOT NULL,
+    PRIMARY KEY (team_id, bucket_start, channel_id)
+);
+CREATE INDEX channel_activity_hll_bucket_start_idx ON channel_activity_hll (bucket_start);
+
+CREATE TABLE channel_activity_hll_monthly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    channel_id TEXT NOT NULL,
+    registers BYTEA NOT NULL,
+    PRIMARY KEY (team_id, bucket_start, channel_id)
+);
+CREATE INDEX channel_activity_hll_monthly_bucket_start_idx ON channel_activity_hll_monthly (bucket_start);
+
+CREATE TABLE report_channels (
+    team_id TEXT PRIMARY KEY,
+    channel_id TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE slack_bots (
+    team_id TEXT PRIMARY KEY,
+    bot_token TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE job_runs (
+    job_id TEXT NOT NULL,
+    run_key TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    lease_expires_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (job_id, run_key)
+);
+
+CREATE TABLE report_runs (
+    team_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    period_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    claimed_by TEXT NOT NULL,
+    claimed_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (team_id, period, period_key)
+);
+
+CREATE TABLE backfill_progress (
+    team_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    oldest TEXT NOT NULL,
+    latest TEXT NOT NULL,
+    next_cursor TEXT,
+    messages INTEGER NOT NULL DEFAULT 0,
+    finished_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (team_id, channel_id)
+);
+
+CREATE TABLE slack_event_ids (
+    event_id TEXT PRIMARY KEY,
+    seen_at TIMESTAMP NOT NULL
+);
+CREATE INDEX slack_event_ids_seen_at_idx ON slack_event_ids (seen_at);
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class StubSlackServer:
+    """Local stand-in for the Slack Web API and slash command response_urls.
+
+    `POST /api/<method>` answers every Web API method with `{"ok": true}`
+    (plus a channel and ts for chat.postMessage) and `POST /response/...`
+    accepts response_url deliveries. Each call sleeps `latency` seconds first
+    and is counted per method.
+
+    conversations.list, conversations.history and conversations.replies page
+    through the history given to add_history(), honouring cursor, limit,
+    oldest and latest like Slack does.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ts = 0
+        self.history = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api/"
+
+    def response_url(self, name):
+        return f"{self.url}/response/{name}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-slack", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def next_ts(self):
+        with self._lock:
+            self._ts += 1
+            return f"{int(time.time())}.{self._ts:06d}"
+
+    def add_history(self, channel_id, messages):
+        """Serves `messages` for `channel_id`; each is a message dict, optionally with a list of 'replies'."""
+        self.history[channel_id] = sorted(messages, key=lambda message: float(message['ts']), reverse=True)
+
+    def handle_api(self, method, params):
+        if method == 'chat.postMessage':
+            return {'ok': True, 'channel': params.get('channel', 'C0'), 'ts': self.next_ts()}
+        if method == 'conversations.list':
+            return page([{'id': channel_id, 'name': channel_id, 'is_member': True} for channel_id in sorted(self.history)], 'channels', params)
+        if method == 'conversations.history':
+            if params.get('channel') not in self.history:
+                return {'ok': False, 'error': 'channel_not_found'}
+            messages = [
+                dict(message, reply_count=len(message['replies']), thread_ts=message['ts']) if message.get('replies')
+                else {key: value for key, value in message.items() if key != 'replies'}
+                for message in self.history[params['channel']]
+                if in_window(message['ts'], params)
+            ]
+            return page(messages, 'messages', params)
+        if method == 'conversations.replies':
+            parent = next((message for message in self.history.get(params.get('channel'), []) if message['ts'] == params.get('ts')), None)
+            if parent is None:
+                return {'ok': False, 'error': 'thread_not_found'}
+            head = {key: value for key, value in parent.items() if key != 'replies'}
+            replies = [reply for reply in parent.get('replies', []) if in_window(reply['ts'], params)]
+            response = page(replies, 'messages', params)
+            response['messages'].insert(0, head)
+            return response
+        return {'ok': True}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if self.path.startswith('/api/'):
+                    method = self.path[len('/api/'):].split('?')[0]
+                    stub.count(method)
+                    payload = stub.handle_api(method, parse_params(self.headers.get('Content-Type', ''), body))
+                    self.respond(200, json.dumps(payload).encode(), 'application/json')
+                elif self.path.startswith('/response/'):
+                    stub.count('response_url')
+                    self.respond(200, b'ok', 'text/plain')
+                else:
+                    self.respond(404, b'not found', 'text/plain')
+
+            def respond(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def in_window(ts, params):
+    ts = float(ts)
+    return float(params.get('oldest') or 0) < ts < float(params.get('latest') or 'inf')
+
+
+def page(items, key, params):
+    offset = int(params.get('cursor') or 0)
+    limit = int(params.get('limit') or 100)
+    next_offset = offset + limit
+    return {
+        'ok': True,
+        key: items[offset:next_offset],
+        'has_more': next_offset < len(items),
+        'response_metadata': {'next_cursor': str(next_offset) if next_offset < len(items) else ''}
+    }
+
+
+def parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
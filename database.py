@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import uuid
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from instrumentation import TimedQueuePool, instrument_engine
+
+logger = logging.getLogger(__name__)
+
+POOLER_MODES = ('session', 'transaction')
+
+
+def env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class Database:
+    """Engine and session factory created on first use and re-pooled after a fork.
+
+    Nothing connects until the first session runs a query. A process forked
+    after the engine was created (e.g. a gunicorn worker of a `--preload`
+    master) gets a fresh pool instead of sharing the parent's connections.
+
+    `pooler='transaction'` is for PgBouncer-style transaction pooling, such as
+    Supabase's pooler on port 6543, where session state does not survive a
+    transaction: the statement timeout is then set with SET LOCAL in every
+    transaction instead of once per connection. `pool_size=0` disables
+    client-side pooling altogether.
+
+    `async_engine` is the same database through asyncpg, with the same pool
+    and timeout settings, for the ASGI app (asgi_app.py).
+    """
+
+    def __init__(self, url, sslmode=None, pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_pre_ping=True, pool_recycle=1800, statement_timeout_ms=0, pooler='session'):
+        if pooler not in POOLER_MODES:
+            raise ValueError(f"Unknown DATABASE_POOLER {pooler!r}, expected one of {POOLER_MODES}")
+        self.url = url
+        self.sslmode = sslmode
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_pre_ping = pool_pre_ping
+        self.pool_recycle = pool_recycle
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pooler = pooler
+        self._engine = None
+        self._pid = None
+        self._async_engine = None
+        self._async_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Builds a Database from DATABASE_URL and the DATABASE_*/DB_* tuning variables."""
+        return cls(
+            os.getenv('DATABASE_URL'),
+            # Only passed to PostgreSQL; an empty value leaves it unset
+            sslmode=os.getenv('DATABASE_SSLMODE', 'require'),
+            pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')),
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+            pool_pre_ping=env_flag('DB_POOL_PRE_PING', 'true'),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '1800')),
+            statement_timeout_ms=int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '0')),
+            pooler=os.getenv('DATABASE_POOLER', 'session')
+        )
+
+    @property
+    def is_postgres(self):
+        return self.url.startswith('postgres')
+
+    @property
+    def engine(self):
+        if self._engine is None or self._pid != os.getpid():
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+                elif self._pid != os.getpid():
+                    # Leaves the parent's connections open for the parent to keep using
+                    self._engine.dispose(close=False)
+                    logger.debug(f"Reset database pool after fork in process {os.getpid()}")
+                self._pid = os.getpid()
+        return self._engine
+
+    def session(self):
+        return Session(bind=self.engine)
+
+    @property
+    def async_engine(self):
+        # Only used from one event loop per process, so no lock; a forked child builds its own
+        if self._async_engine is None or self._async_pid != os.getpid():
+            self._async_engine = self._create_async_engine()
+            self._async_pid = os.getpid()
+        return self._async_engine
+
+    def async_session(self):
+        return AsyncSession(bind=self.async_engine, expire_on_commit=False)
+
+    def _create_async_engine(self):
+        if not self.is_postgres:
+            raise ValueError("The async engine needs a PostgreSQL DATABASE_URL")
+        url = make_url(self.url).set(drivername='postgresql+asyncpg')
+        connect_args = {}
+        if self.sslmode:
+            connect_args['ssl'] = self.sslmode
+        if self.statement_timeout_ms and self.pooler == 'session':
+            connect_args['server_settings'] = {'statement_timeout': str(self.statement_timeout_ms)}
+        if self.pooler == 'transaction':
+            # Prepared statements do not survive a transaction-mode pooler either
+            url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+            connect_args['statement_cache_size'] = 0
+            connect_args['prepared_statement_name_func'] = lambda: f"__asyncpg_{uuid.uuid4()}__"
+        options = {'pool_pre_ping': self.pool_pre_ping}
+        if self.pool_size > 0:
+            options.update(
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_timeout=self.pool_timeout,
+                pool_recycle=self.pool_recycle
+            )
+        else:
+            options['poolclass'] = NullPool
+
+        engine = create_async_engine(url, connect_args=connect_args, **options)
+        instrument_engine(engine.sync_engine)
+
+        if self.statement_timeout_ms and self.pooler == 'transaction':
+            timeout = int(self.statement_timeout_ms)
+
+            @event.listens_for(engine.sync_engine, 'begin')
+            def set_statement_timeout(conn):
+                conn.exec_driver_sql(f"SET LOCAL statement_timeout = {timeout}")
+
+        logger.info(f"Created asyncpg engine ({self.pooler} pooling, pool size {self.pool_size})")
+        return engine
+
+    def _create_engine(self):
+        connect_args = {}
+        options = {}
+        if self.is_postgres:
+            if self.sslmode:
+                connect_args['sslmode'] = self.sslmode
+            if self.statement_timeout_ms and self.pooler == 'session':
+                connect_args['options'] = f"-c statement_timeout={self.statement_timeout_ms}"
+            if self.pool_size > 0:
+                options.update(
+                    poolclass=TimedQueuePool,
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow,
+                    pool_timeout=self.pool_timeout,
+                    pool_recycle=self.pool_recycle
+                )
+            else:
+                options['poolclass'] = NullPool
+            options['pool_pre_ping'] = self.pool_pre_ping
+
+        engine = create_engine(self.url, connect_args=connect_args, **options)
+        instrument_engine(engine)
+
+        if self.is_postgres and self.statement_timeout_ms and self.pooler == 'transaction':
+            timeout = int(self.statement_timeout_ms)
+
+            @event.listens_for(engine, 'begin')
+            def set_statement_timeout(conn):
+                conn.exec_driver_sql(f"SET LOCAL statement_timeout = {timeout}")
+
+        logger.info(f"Created {engine.dialect.name} engine ({self.pooler} pooling, pool size {self.pool_size})")
+        return engine
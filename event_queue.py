@@ -0,0 +1,225 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of EventDispatcher.submit
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+DROPPED = 'dropped'
+REJECTED = 'rejected'
+
+FULL_POLICIES = ('block', 'drop', '503')
+
+# Keys per INSERT when SharedSeenSet writes its queued keys
+DEDUPE_BATCH_SIZE = 500
+
+_STOP = object()
+
+
+class SeenSet:
+    """Thread-safe set of keys that forgets each key `ttl` seconds after it was added."""
+
+    def __init__(self, ttl=600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, retry=False):
+        """Adds `key` and returns True, or returns False if it was already present.
+
+        `retry` is accepted for compatibility with SharedSeenSet and ignored.
+        """
+        now = time.monotonic()
+        with self._lock:
+            # Keys are inserted with a constant TTL, so the oldest expire first
+            while self._expiry:
+                oldest_key, expires_at = next(iter(self._expiry.items()))
+                if expires_at > now and len(self._expiry) < self.max_size:
+                    break
+                del self._expiry[oldest_key]
+
+            if key in self._expiry:
+                return False
+            self._expiry[key] = now + self.ttl
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._expiry.pop(key, None)
+
+    def __len__(self):
+        return len(self._expiry)
+
+
+class SharedSeenSet:
+    """SeenSet whose keys live in the slack_event_ids table, so a Slack retry is
+    recognised whichever worker or instance it reaches.
+
+    First deliveries only touch memory: their keys are queued and written in
+    batches by write(), which the metrics buffer calls on each flush. Only a
+    retry queries the table. A row older than `ttl` counts as absent, and
+    expire() deletes such rows. If the database cannot be reached a retry is
+    accepted, since counting an event twice is better than dropping it.
+    """
+
+    def __init__(self, session_factory, ttl=600, max_size=100000):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.local = SeenSet(ttl, max_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, retry=False):
+        if not self.local.add(key):
+            return False
+        now = datetime.utcnow()
+        if not retry:
+            with self._lock:
+                self._pending[key] = now
+            return True
+        try:
+            with self.session_factory() as session:
+                added = session.execute(text("""
+                    INSERT INTO slack_event_ids (event_id, seen_at) VALUES (:event_id, :now)
+                    ON CONFLICT (event_id) DO UPDATE SET seen_at = EXCLUDED.seen_at
+                    WHERE slack_event_ids.seen_at < :expired
+                """), {'event_id': key, 'now': now, 'expired': now - timedelta(seconds=self.ttl)}).rowcount
+                session.commit()
+        except Exception as e:
+            logger.warning(f"Could not check retried event {key} in the shared dedupe store, accepting it: {e}")
+            return True
+        return added > 0
+
+    def discard(self, key):
+        self.local.discard(key)
+        with self._lock:
+            if self._pending.pop(key, None) is not None:
+                return
+        try:
+            with self.session_factory() as session:
+                session.execute(text("DELETE FROM slack_event_ids WHERE event_id = :event_id"), {'event_id': key})
+                session.commit()
+        except Exception as e:
+            logger.warning(f"Could not forget event {key} in the shared dedupe store: {e}")
+
+    def write(self, session):
+        """Adds the queued keys to the table without committing; returns how many."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        # Key order, like the metric upserts, so concurrent writers cannot deadlock
+        rows = sorted(pending.items())
+        for start in range(0, len(rows), DEDUPE_BATCH_SIZE):
+            values = []
+            params = {}
+            for i, (key, seen_at) in enumerate(rows[start:start + DEDUPE_BATCH_SIZE]):
+                values.append(f"(:event_id_{i}, :seen_at_{i})")
+                params[f'event_id_{i}'] = key
+                params[f'seen_at_{i}'] = seen_at
+            session.execute(text(f"""
+                INSERT INTO slack_event_ids (event_id, seen_at) VALUES {", ".join(values)}
+                ON CONFLICT (event_id) DO UPDATE SET seen_at = EXCLUDED.seen_at
+            """), params)
+        return len(rows)
+
+    def expire(self):
+        """Deletes rows older than the TTL; returns how many."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        with self.session_factory() as session:
+            deleted = session.execute(text("DELETE FROM slack_event_ids WHERE seen_at < :cutoff"), {'cutoff': cutoff}).rowcount
+            session.commit()
+        return deleted
+
+    def __len__(self):
+        return len(self.local)
+
+
+class EventDispatcher:
+    """Bounded queue of Slack event payloads drained by a pool of worker threads.
+
+    `full_policy` decides what `submit` does when the queue is full: 'block'
+    waits up to `block_timeout` seconds for room and then rejects, 'drop'
+    discards the event, and '503' rejects it straight away so the caller can
+    ask Slack to retry later.
+    """
+
+    def __init__(self, handler, workers=4, max_queue=1000, full_policy='block', block_timeout=1.0):
+        if full_policy not in FULL_POLICIES:
+            raise ValueError(f"Unknown queue full policy {full_policy!r}, expected one of {', '.join(FULL_POLICIES)}")
+        self.handler = handler
+        self.workers = workers
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, payload):
+        if self._closed:
+            return REJECTED
+        self._ensure_started()
+
+        try:
+            if self.full_policy == 'block':
+                self._queue.put(payload, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(payload)
+        except queue.Full:
+            if self.full_policy == 'drop':
+                logger.warning("Event queue full, dropping event")
+                return DROPPED
+            logger.warning("Event queue full, rejecting event")
+            return REJECTED
+        return QUEUED
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def fill(self):
+        """Fraction of the queue's capacity in use."""
+        return self._queue.qsize() / self._queue.maxsize if self._queue.maxsize > 0 else 0.0
+
+    def _ensure_started(self):
+        # Started lazily so the threads are created in the process that uses them
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"event-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                if payload is _STOP:
+                    return
+                self.handler(payload)
+            except Exception as e:
+                logger.error(f"Error processing queued event: {e}")
+            finally:
+                self._queue.task_done()
+
+    def close(self, timeout=10.0):
+        """Stops accepting events and waits for the queued ones to be processed."""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
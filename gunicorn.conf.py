@@ -0,0 +1,28 @@
+# Gunicorn reads this file from the working directory: `gunicorn 'app:create_app()'`.
+# Worker count comes from WEB_CONCURRENCY and the port from PORT, as gunicorn does by default.
+import fcntl
+import os
+import tempfile
+
+# Import the app once in the master so workers fork ready to serve. create_app() opens no
+# connections and starts no threads, so each worker creates its own after the fork.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes', 'on')
+
+
+def post_worker_init(worker):
+    # Runs in each worker after the app is loaded. Only the worker holding the instance's scheduler lock
+    # starts the scheduler (if SCHEDULER_ENABLED is set); the lock is freed when that worker exits and
+    # its replacement takes it over.
+    import app
+
+    path = os.path.join(tempfile.gettempdir(), f"slack-bot-scheduler-{os.getppid()}.lock")
+    worker.scheduler_lock = open(path, 'w')
+    try:
+        fcntl.flock(worker.scheduler_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        worker.scheduler_lock.close()
+        return
+    app.start_scheduler()
+
+# Threads per worker, so a long streaming export does not hold up a worker's other requests
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
@@ -0,0 +1,232 @@
+import functools
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Distinct normalized statement labels, beyond which new statements share the label 'other'
+MAX_STATEMENTS = 500
+# Raw statement texts whose labels are cached; others are normalized on every execution
+MAX_CACHED_STATEMENTS = 2000
+STATEMENT_LABEL_LENGTH = 120
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class StatsRegistry:
+    """Latency histograms, counters and gauges rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counters(self, name):
+        """Current values of counter `name`, keyed by label tuple."""
+        with self._lock:
+            return {key[1]: value for key, value in self._counters.items() if key[0] == name}
+
+    def gauge(self, name, func, help_text=None):
+        """Registers `func`, called at render time, returning a number or a {labels_tuple: number} dict."""
+        self._gauges[name] = func
+        if help_text:
+            self.describe(name, help_text)
+
+    def timed(self, name, **labels):
+        """Decorator recording each call's duration in histogram `name` with an `outcome` label."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = 'error'
+                try:
+                    result = func(*args, **kwargs)
+                    outcome = 'ok'
+                    return result
+                finally:
+                    self.observe(name, time.perf_counter() - started, outcome=outcome, **labels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        for name, series in group_by_name(histograms):
+            self._header(lines, name, 'histogram')
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        for name, series in group_by_name(counters):
+            self._header(lines, name, 'counter')
+            for labels, value in series:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            self._header(lines, name, 'gauge')
+            if isinstance(value, dict):
+                for labels, number in sorted(value.items()):
+                    lines.append(f"{name}{format_labels(labels)} {number}")
+            else:
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def group_by_name(items):
+    grouped = {}
+    for (name, labels), value in items:
+        grouped.setdefault(name, []).append((labels, value))
+    return sorted(grouped.items())
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+stats = StatsRegistry()
+stats.describe('http_request_duration_seconds', "Flask route latency")
+stats.describe('db_statement_duration_seconds', "SQL statement execution time, grouped by statement")
+stats.describe('db_pool_checkout_wait_seconds', "Time spent waiting for a pooled database connection")
+stats.describe('slack_api_duration_seconds', "Slack Web API call latency, grouped by method")
+stats.describe('scheduler_job_duration_seconds', "Scheduled job run time")
+
+_statement_labels = {}
+_labels = set()
+_values_list = re.compile(r"\bVALUES\s*\(.*?\)(\s*,\s*\(.*?\))*", re.IGNORECASE | re.DOTALL)
+_expanded_params = re.compile(r"\((\s*(%\(\w+\)s|\?|:\w+)\s*,)+\s*(%\(\w+\)s|\?|:\w+)\s*\)")
+
+
+def statement_label(statement):
+    label = _statement_labels.get(statement)
+    if label is not None:
+        return label
+    # Multi-row VALUES and expanded IN lists differ only in length, so they collapse to one label
+    normalized = _values_list.sub("VALUES (...)", statement)
+    normalized = _expanded_params.sub("(...)", normalized)
+    label = " ".join(normalized.split())[:STATEMENT_LABEL_LENGTH]
+    if label not in _labels:
+        if len(_labels) >= MAX_STATEMENTS:
+            return 'other'
+        _labels.add(label)
+    if len(_statement_labels) < MAX_CACHED_STATEMENTS:
+        _statement_labels[statement] = label
+    return label
+
+
+def instrument_engine(engine):
+    """Times every statement executed through `engine`."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['statement_started'].pop()
+        stats.observe('db_statement_duration_seconds', time.perf_counter() - started, statement=statement_label(statement))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # after_cursor_execute never runs for a failed statement
+        if context.connection is not None and context.connection.info.get('statement_started'):
+            context.connection.info['statement_started'].pop()
+
+    stats.gauge(
+        'db_pool_checked_out_connections',
+        lambda: engine.pool.checkedout() if hasattr(engine.pool, 'checkedout') else 0,
+        "Connections currently checked out of the pool"
+    )
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats.observe('db_pool_checkout_wait_seconds', time.perf_counter() - started)
+
+
+def instrument_flask(app):
+    """Records the latency of every request by route rule and status."""
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            stats.observe(
+                'http_request_duration_seconds',
+                time.perf_counter() - started,
+                route=route,
+                method=request.method,
+                status=response.status_code
+            )
+        return response
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LeaderboardCache:
+    """TTL + LRU cache of per-team leaderboards, keyed by (team_id, timeframe, order).
+
+    `order` is 'top' or 'bottom'. Each entry keeps the first `k` rows it was
+    filled with, so any request for `limit <= k` rows is answered from it.
+    An entry holding fewer than `k` rows is the complete leaderboard and
+    answers every limit.
+    """
+
+    def __init__(self, ttl=30, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, team_id, timeframe, limit, order='top'):
+        key = (team_id, timeframe, order)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                rows, k, expires_at = entry
+                if expires_at <= time.monotonic():
+                    del self._entries[key]
+                elif limit <= k or len(rows) < k:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return rows[:limit]
+            self.misses += 1
+            return None
+
+    def put(self, team_id, timeframe, k, rows, order='top'):
+        key = (team_id, timeframe, order)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            # Never replace a live larger leaderboard with a smaller one
+            if entry is not None and entry[2] > now and entry[1] > k:
+                return
+            self._entries[key] = (rows, k, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_teams(self, team_ids):
+        with self._lock:
+            stale = [key for key in self._entries if key[0] in team_ids]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl
+            }
@@ -0,0 +1,206 @@
+import atexit
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from metrics_store import (
+    ACTIVITY_TABLE, BIN_KEY_COLUMNS, BIN_VALUE_COLUMNS, HOURLY_BINS_TABLE, HOURLY_TABLE,
+    METRIC_KEY_COLUMNS, METRIC_VALUE_COLUMNS, day_bucket, hour_bucket, merge_sketches, upsert_sql,
+)
+from sketches import HyperLogLog, response_time_bin
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT statement, keeps the bind parameter count well under driver limits
+BATCH_SIZE = 500
+
+
+class MetricsBuffer:
+    """In-process write-behind buffer for the hourly per-(team, user, channel) counters,
+    per-(team, user) response-time sketch bins and the users active in each
+    channel per day.
+
+    Events only touch memory; the buffer is written out as multi-row upserts
+    once it holds `max_keys` distinct keys or its oldest entry is
+    `max_staleness` seconds old, and once more at interpreter shutdown.
+    A `max_staleness` of 0, or a closed buffer, writes every event through
+    immediately. `on_flush`, if given, is called with the set of team_ids
+    written by each successful flush. `on_write`, if given, is called with
+    each flush's session before it commits, so other batched writes share
+    its transaction.
+    """
+
+    def __init__(self, session_factory, max_keys=500, max_staleness=5.0, on_flush=None, on_write=None):
+        self.session_factory = session_factory
+        self.on_flush = on_flush
+        self.on_write = on_write
+        self.max_keys = max_keys
+        self.max_staleness = max_staleness
+        self._pending = {}
+        self._bins = {}
+        self._active = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record_message(self, team_id, user_id, channel_id, response_time=None, ts=None):
+        self._add(team_id, hour_bucket(ts), user_id, channel_id, 1, 0, response_time)
+
+    def record_reaction(self, team_id, user_id, channel_id, ts=None):
+        self._add(team_id, hour_bucket(ts), user_id, channel_id, 0, 1, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _add(self, team_id, bucket_start, user_id, channel_id, messages, reactions, response_time):
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            add_counts(self._pending, self._bins, team_id, bucket_start, user_id, channel_id, messages, reactions,
+                       response_time, self._active)
+            full = len(self._pending) >= self.max_keys
+
+        if self.max_staleness <= 0 or self._stopped.is_set():
+            self.flush()
+            return
+
+        self._ensure_started()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_started(self):
+        # Started lazily so the thread is created in the process that uses it
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-buffer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                oldest = self._oldest
+                size = len(self._pending)
+            if oldest is None:
+                timeout = self.max_staleness
+            else:
+                timeout = self.max_staleness - (time.monotonic() - oldest)
+
+            if size >= self.max_keys or (oldest is not None and timeout <= 0):
+                self.flush()
+                continue
+
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                bins, self._bins = self._bins, {}
+                active, self._active = self._active, {}
+                self._oldest = None
+            if not pending:
+                return 0
+
+            try:
+                self._write(pending, bins, active)
+            except Exception as e:
+                logger.error(f"Failed to flush {len(pending)} metric keys, requeueing: {e}")
+                self._requeue(pending, bins, active)
+                return 0
+
+            logger.debug(f"Flushed {len(pending)} metric keys and {len(bins)} response-time bins")
+            if self.on_flush is not None:
+                self.on_flush({key[0] for key in pending})
+            return len(pending)
+
+    def _requeue(self, pending, bins, active):
+        with self._lock:
+            for key, values in pending.items():
+                entry = self._pending.get(key)
+                if entry is None:
+                    self._pending[key] = values
+                    continue
+                for i, value in enumerate(values):
+                    entry[i] += value
+            for key, count in bins.items():
+                self._bins[key] = self._bins.get(key, 0) + count
+            for key, users in active.items():
+                self._active.setdefault(key, set()).update(users)
+            if self._pending and self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def _write(self, pending, bins, active):
+        with self.session_factory() as session:
+            write_counts(session, pending, bins, active)
+            if self.on_write is not None:
+                self.on_write(session)
+            session.commit()
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self.flush()
+
+
+def add_counts(pending, bins, team_id, bucket_start, user_id, channel_id, messages, reactions, response_time, active=None):
+    """Adds one event to `pending`, {metric key: counters}, and its response time to `bins`, {bin key: count}.
+
+    If given, `active` collects the users seen per (team_id, day, channel_id).
+    """
+    key = (team_id, bucket_start, user_id, channel_id)
+    entry = pending.get(key)
+    if entry is None:
+        entry = pending[key] = [0, 0, 0.0, 0]
+    entry[0] += messages
+    entry[1] += reactions
+    if response_time is not None:
+        entry[2] += response_time
+        entry[3] += 1
+        bin_key = (team_id, bucket_start, user_id, response_time_bin(response_time))
+        bins[bin_key] = bins.get(bin_key, 0) + 1
+    if active is not None:
+        active.setdefault((team_id, day_bucket(bucket_start), channel_id), set()).add(user_id)
+
+
+def write_counts(session, pending, bins, active=None):
+    """Adds counters, response-time bins and active users collected by add_counts() to the database, without committing."""
+    write_rows(session, HOURLY_TABLE, METRIC_KEY_COLUMNS, METRIC_VALUE_COLUMNS, pending.items())
+    write_rows(session, HOURLY_BINS_TABLE, BIN_KEY_COLUMNS, BIN_VALUE_COLUMNS,
+               ((key, (count,)) for key, count in bins.items()))
+    if active:
+        merge_sketches(session, ACTIVITY_TABLE, {key: user_sketch(users) for key, users in active.items()})
+
+
+def user_sketch(user_ids):
+    sketch = HyperLogLog()
+    for user_id in user_ids:
+        sketch.add(user_id)
+    return sketch
+
+
+def write_rows(session, table, key_columns, value_columns, rows):
+    """Adds `rows`, (key, values) pairs, into `table` with multi-row upserts of BATCH_SIZE rows.
+
+    Rows go in key order, so concurrent flushes of overlapping keys lock
+    their conflicting rows in the same order and cannot deadlock.
+    """
+    rows = sorted(rows, key=lambda row: row[0])
+    columns = key_columns + value_columns
+    for start in range(0, len(rows), BATCH_SIZE):
+        values = []
+        params = {}
+        for i, (key, counts) in enumerate(rows[start:start + BATCH_SIZE]):
+            values.append("(" + ", ".join(f":{column}_{i}" for column in columns) + ")")
+            params.update({f'{column}_{i}': value for column, value in zip(columns, tuple(key) + tuple(counts))})
+        session.execute(text(upsert_sql(table, key_columns, value_columns, ", ".join(values))), params)
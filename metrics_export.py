@@ -0,0 +1,100 @@
+"""Streams a team's per-user, per-channel totals for a date range as CSV or NDJSON.
+
+Rows come from a server-side cursor `fetch_size` rows at a time and are
+encoded as they arrive, so memory stays flat however many users and
+channels a team has. Buckets are selected by bucket_start, so the range
+edges have the granularity of the buckets they fall in: hours for the
+last couple of days, days, and months beyond the daily retention.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy import text
+
+from metrics_store import buckets_query
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+# Characters of encoded rows per response write
+CHUNK_SIZE = 64 * 1024
+EXPORT_COLUMNS = ('user_id', 'channel_id', 'message_count', 'reaction_count', 'response_count', 'avg_response_time')
+
+
+def parse_date(value):
+    """Parses an ISO date or datetime in UTC; raises ValueError for anything else."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        raise ValueError(f"Expected a UTC time without an offset: {value}")
+    return parsed
+
+
+def export_rows(session, team_id, start, end, fetch_size=1000):
+    """Yields one tuple of EXPORT_COLUMNS per (user, channel) active in [start, end)."""
+    query = text(f"""
+        SELECT
+            user_id,
+            channel_id,
+            SUM(message_count) as message_count,
+            SUM(reaction_count) as reaction_count,
+            SUM(response_count) as response_count,
+            SUM(response_time_sum) / NULLIF(SUM(response_count), 0) as avg_response_time
+        FROM (
+{buckets_query("user_id, channel_id, message_count, reaction_count, response_time_sum, response_count", where="bucket_start < :until")}
+        ) buckets
+        GROUP BY user_id, channel_id
+        ORDER BY user_id, channel_id
+    """).execution_options(yield_per=fetch_size)
+    result = session.execute(query, {'team_id': team_id, 'since': start, 'until': end})
+    for rows in result.partitions(fetch_size):
+        for user_id, channel_id, messages, reactions, responses, avg_response in rows:
+            yield (
+                user_id,
+                channel_id,
+                int(messages),
+                int(reactions),
+                int(responses),
+                round(float(avg_response), 3) if avg_response is not None else None
+            )
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in chain([EXPORT_COLUMNS], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+
+
+def chunked(lines, chunk_size=CHUNK_SIZE):
+    """Joins lines into chunks of about `chunk_size` characters, one response write each."""
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def stream_export(session_factory, team_id, start, end, export_format='csv', fetch_size=1000):
+    """Yields the encoded export; the session stays open until the generator is exhausted or closed."""
+    with session_factory() as session:
+        rows = export_rows(session, team_id, start, end, fetch_size)
+        lines = csv_lines(rows) if export_format == 'csv' else ndjson_lines(rows)
+        yield from chunked(lines)
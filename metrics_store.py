@@ -0,0 +1,229 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+
+from sketches import DDSketch, HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# Bucket tables, finest first. All are keyed by (team_id, bucket_start, user_id, channel_id).
+HOURLY_TABLE = 'metrics_hourly'
+DAILY_TABLE = 'metrics_daily'
+MONTHLY_TABLE = 'metrics_monthly'
+BUCKET_TABLES = (HOURLY_TABLE, DAILY_TABLE, MONTHLY_TABLE)
+METRIC_KEY_COLUMNS = ('team_id', 'bucket_start', 'user_id', 'channel_id')
+METRIC_VALUE_COLUMNS = ('message_count', 'reaction_count', 'response_time_sum', 'response_count')
+
+# Response-time sketch bins (see sketches.py), keyed by (team_id, bucket_start, user_id, bin_index)
+# and rolled up alongside the counters
+HOURLY_BINS_TABLE = 'response_time_bins_hourly'
+DAILY_BINS_TABLE = 'response_time_bins_daily'
+MONTHLY_BINS_TABLE = 'response_time_bins_monthly'
+BIN_TABLES = (HOURLY_BINS_TABLE, DAILY_BINS_TABLE, MONTHLY_BINS_TABLE)
+BIN_KEY_COLUMNS = ('team_id', 'bucket_start', 'user_id', 'bin_index')
+BIN_VALUE_COLUMNS = ('sample_count',)
+
+# Distinct-user HyperLogLog sketches (see sketches.py), keyed by (team_id, bucket_start, channel_id).
+# Days older than the daily retention are merged into monthly sketches.
+ACTIVITY_TABLE = 'channel_activity_hll'
+MONTHLY_ACTIVITY_TABLE = 'channel_activity_hll_monthly'
+ACTIVITY_TABLES = (ACTIVITY_TABLE, MONTHLY_ACTIVITY_TABLE)
+
+# Sketch rows per merge statement
+SKETCH_BATCH_SIZE = 200
+
+
+def utcnow():
+    return datetime.utcnow()
+
+
+def hour_bucket(ts=None):
+    """Start of the UTC hour containing epoch seconds `ts` (now if None), as a naive datetime."""
+    moment = utcnow() if ts is None else datetime.utcfromtimestamp(ts)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_timeframe(timeframe):
+    """Turns a timeframe such as '7 days' or '12 hours' into a timedelta."""
+    amount, unit = timeframe.split()
+    unit = unit.lower().rstrip('s')
+    if unit == 'day':
+        return timedelta(days=int(amount))
+    if unit == 'hour':
+        return timedelta(hours=int(amount))
+    raise ValueError(f"Unsupported timeframe: {timeframe}")
+
+
+def since(timeframe):
+    return utcnow() - parse_timeframe(timeframe)
+
+
+def buckets_query(columns, per_team=True, tables=BUCKET_TABLES, where=None):
+    """UNION ALL of `columns` over every bucket table for buckets starting at or after :since.
+
+    With `per_team` the buckets are also restricted to :team_id, and `where`
+    adds any further condition.
+
+    Completed hours are moved from the hourly into the daily table, and old
+    days into the monthly table, so no two tables hold the same activity and
+    the union can be summed directly.
+    """
+    conditions = ["team_id = :team_id"] if per_team else []
+    conditions.append("bucket_start >= :since")
+    if where:
+        conditions.append(where)
+    return "\n        UNION ALL\n".join(
+        f"        SELECT {columns} FROM {table} WHERE {' AND '.join(conditions)}"
+        for table in tables
+    )
+
+
+def upsert_sql(table, key_columns, value_columns, values):
+    """Multi-row INSERT of `values` into `table` that adds the value columns to any existing row."""
+    columns = key_columns + value_columns
+    updates = ",\n            ".join(f"{column} = {table}.{column} + EXCLUDED.{column}" for column in value_columns)
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES {values}
+        ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET
+            {updates}
+    """
+
+
+def response_time_percentiles(session, team_id, user_ids, since_time, quantiles=(0.5, 0.95)):
+    """Merges the response-time sketches of `user_ids` since `since_time`; returns {user_id: [value per quantile]}."""
+    if not user_ids:
+        return {}
+    query = text(f"""
+        SELECT user_id, bin_index, SUM(sample_count)
+        FROM (
+{buckets_query("user_id, bin_index, sample_count", tables=BIN_TABLES, where="user_id IN :user_ids")}
+        ) bins
+        GROUP BY user_id, bin_index
+    """).bindparams(bindparam('user_ids', expanding=True))
+
+    sketches = {}
+    for user_id, bin_index, count in session.execute(query, {'team_id': team_id, 'since': since_time, 'user_ids': list(user_ids)}):
+        sketches.setdefault(user_id, DDSketch()).merge_bins([(bin_index, int(count))])
+    return {user_id: [sketch.quantile(q) for q in quantiles] for user_id, sketch in sketches.items()}
+
+
+def merge_sketches(session, table, sketches):
+    """Merges `sketches`, {(team_id, bucket_start, channel_id): HyperLogLog}, into `table`, without committing.
+
+    Missing rows are created first and every row is locked while it is read,
+    merged and written back, in key order so concurrent writers cannot
+    deadlock. SQLite has no row locks and relies on its single writer.
+    """
+    keys = sorted(sketches)
+    lock = " FOR UPDATE OF stored" if session.bind.dialect.name == 'postgresql' else ""
+    for start in range(0, len(keys), SKETCH_BATCH_SIZE):
+        batch = keys[start:start + SKETCH_BATCH_SIZE]
+        params = {'empty': b''}
+        values = []
+        for i, (team_id, bucket_start, channel_id) in enumerate(batch):
+            values.append(f"({i}, :team_id_{i}, :bucket_start_{i}, :channel_id_{i})")
+            params.update({f'team_id_{i}': team_id, f'bucket_start_{i}': bucket_start, f'channel_id_{i}': channel_id})
+        values = ", ".join(values)
+
+        session.execute(text(f"""
+            INSERT INTO {table} (team_id, bucket_start, channel_id, registers)
+            SELECT column2, column3, column4, :empty FROM (VALUES {values}) AS batch WHERE true
+            ON CONFLICT (team_id, bucket_start, channel_id) DO NOTHING
+        """), params)
+        rows = session.execute(text(f"""
+            SELECT batch.column1, stored.registers
+            FROM {table} stored
+            JOIN (VALUES {values}) AS batch
+                ON stored.team_id = batch.column2 AND stored.bucket_start = batch.column3 AND stored.channel_id = batch.column4
+            ORDER BY batch.column1{lock}
+        """), params).fetchall()
+
+        updates = []
+        for i, registers in rows:
+            team_id, bucket_start, channel_id = batch[i]
+            sketch = sketches[batch[i]]
+            sketch.merge_bytes(registers)
+            updates.append({'team_id': team_id, 'bucket_start': bucket_start, 'channel_id': channel_id,
+                            'registers': sketch.to_bytes()})
+        session.execute(text(f"""
+            UPDATE {table} SET registers = :registers
+            WHERE team_id = :team_id AND bucket_start = :bucket_start AND channel_id = :channel_id
+        """), updates)
+
+
+def channel_activity(session, team_id, since_time, fetch_size=500):
+    """Distinct active users per channel since `since_time`, and across all of them.
+
+    Returns (total, [(channel_id, users)] busiest first). Whole days (or
+    months, past the daily retention) starting at or after `since_time` are
+    merged, so the work depends on the number of channels and days, not on
+    the number of users.
+    """
+    query = text(f"""
+        SELECT channel_id, registers
+        FROM (
+{buckets_query("channel_id, registers", tables=ACTIVITY_TABLES)}
+        ) sketches
+    """).execution_options(yield_per=fetch_size)
+    total = HyperLogLog()
+    channels = {}
+    result = session.execute(query, {'team_id': team_id, 'since': since_time})
+    for rows in result.partitions(fetch_size):
+        for channel_id, registers in rows:
+            channel = channels.get(channel_id)
+            if channel is None:
+                channel = channels[channel_id] = HyperLogLog()
+            channel.merge_bytes(registers)
+    for channel in channels.values():
+        total.update(channel)
+    counts = sorted(((channel_id, sketch.count()) for channel_id, sketch in channels.items()),
+                    key=lambda item: (-item[1], item[0]))
+    return total.count(), counts
+
+
+def rollup_table(session, source, target, key_columns, value_columns, cutoff, truncate='day', delete=True):
+    """Adds rows of `source` older than `cutoff` into `target`, truncating bucket_start and summing the values.
+
+    With `delete` the rows are also removed from `source`; without it the
+    caller is expected to drop them some cheaper way, such as dropping the
+    partition that holds them.
+    """
+    columns = ", ".join(key_columns + value_columns)
+    if delete:
+        rows = f"DELETE FROM {source} WHERE bucket_start < :cutoff RETURNING {columns}"
+    else:
+        rows = f"SELECT {columns} FROM {source} WHERE bucket_start < :cutoff"
+    grouped = ", ".join(
+        f"date_trunc('{truncate}', bucket_start)" if column == 'bucket_start' else column
+        for column in key_columns
+    )
+    sums = ", ".join(f"SUM({column})" for column in value_columns)
+    updates = ",\n            ".join(f"{column} = {target}.{column} + EXCLUDED.{column}" for column in value_columns)
+    result = session.execute(text(f"""
+        WITH moved AS (
+            {rows}
+        )
+        INSERT INTO {target} ({columns})
+        SELECT {grouped}, {sums}
+        FROM moved
+        GROUP BY {grouped}
+        ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET
+            {updates}
+    """), {'cutoff': cutoff})
+    return result.rowcount
+
+
+def rollup_hourly(session, retention_hours=48):
+    """Folds hourly buckets from whole UTC days older than `retention_hours` into daily buckets."""
+    cutoff = day_bucket(utcnow() - timedelta(hours=retention_hours))
+    buckets = rollup_table(session, HOURLY_TABLE, DAILY_TABLE, METRIC_KEY_COLUMNS, METRIC_VALUE_COLUMNS, cutoff)
+    bins = rollup_table(session, HOURLY_BINS_TABLE, DAILY_BINS_TABLE, BIN_KEY_COLUMNS, BIN_VALUE_COLUMNS, cutoff)
+    session.commit()
+    logger.info(f"Rolled hourly metrics before {cutoff} into {buckets} daily buckets and {bins} response-time bins")
+    return buckets
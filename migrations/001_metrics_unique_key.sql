@@ -0,0 +1,31 @@
+-- Adds the (team_id, user_id, channel_id) unique key that the batched
+-- INSERT ... ON CONFLICT upserts in metrics_buffer.py rely on.
+BEGIN;
+
+-- Fold any duplicate rows into the lowest id before adding the key
+UPDATE metrics m
+SET message_count = agg.message_count,
+    reaction_count = agg.reaction_count,
+    recorded_at = agg.recorded_at
+FROM (
+    SELECT MIN(id) AS id,
+           SUM(message_count) AS message_count,
+           SUM(reaction_count) AS reaction_count,
+           MAX(recorded_at) AS recorded_at
+    FROM metrics
+    GROUP BY team_id, user_id, channel_id
+    HAVING COUNT(*) > 1
+) agg
+WHERE m.id = agg.id;
+
+DELETE FROM metrics m
+USING metrics keep
+WHERE m.team_id = keep.team_id
+  AND m.user_id = keep.user_id
+  AND m.channel_id = keep.channel_id
+  AND m.id > keep.id;
+
+ALTER TABLE metrics
+    ADD CONSTRAINT metrics_team_user_channel_key UNIQUE (team_id, user_id, channel_id);
+
+COMMIT;
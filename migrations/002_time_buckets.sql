@@ -0,0 +1,51 @@
+-- Replaces the cumulative metrics table with hourly and daily buckets.
+-- Live events are written to metrics_hourly; the hourly rollup job moves
+-- whole days older than METRICS_HOURLY_RETENTION_HOURS into metrics_daily.
+BEGIN;
+
+CREATE TABLE metrics_hourly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_hourly_bucket_start_idx ON metrics_hourly (bucket_start);
+
+CREATE TABLE metrics_daily (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_daily_bucket_start_idx ON metrics_daily (bucket_start);
+
+-- The old rows only know their lifetime totals and when they last changed,
+-- so each one becomes a single daily bucket on the day of its last activity.
+-- Only the last reply's response time was kept, so it counts as one sample.
+INSERT INTO metrics_daily (team_id, bucket_start, user_id, channel_id,
+                           message_count, reaction_count, response_time_sum, response_count)
+SELECT team_id,
+       date_trunc('day', recorded_at),
+       user_id,
+       channel_id,
+       SUM(message_count),
+       SUM(reaction_count),
+       COALESCE(SUM(response_time), 0),
+       COUNT(response_time)
+FROM metrics
+GROUP BY team_id, date_trunc('day', recorded_at), user_id, channel_id;
+
+-- Kept for reference; nothing reads or writes it any more
+ALTER TABLE metrics RENAME TO metrics_legacy;
+
+COMMIT;
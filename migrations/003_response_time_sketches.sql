@@ -0,0 +1,27 @@
+-- Response-time sketch bins per user and bucket (see sketches.py). Each row
+-- counts the replies whose response time fell in one logarithmic bin, so
+-- sketches merge across buckets by summing sample_count per bin_index.
+-- Existing buckets have no bins; their percentiles show as N/A.
+BEGIN;
+
+CREATE TABLE response_time_bins_hourly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_hourly_bucket_start_idx ON response_time_bins_hourly (bucket_start);
+
+CREATE TABLE response_time_bins_daily (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_daily_bucket_start_idx ON response_time_bins_daily (bucket_start);
+
+COMMIT;
@@ -0,0 +1,27 @@
+-- Run ledger for scheduled jobs. job_runs holds one row per job firing and
+-- elects the process that runs it; report_runs records each team's report
+-- per period so retries and catch-up runs never post it twice.
+-- With SCHEDULER_MODE=cluster the scheduler also creates apscheduler_jobs itself.
+BEGIN;
+
+CREATE TABLE job_runs (
+    job_id TEXT NOT NULL,
+    run_key TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    lease_expires_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (job_id, run_key)
+);
+
+CREATE TABLE report_runs (
+    team_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    period_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    claimed_by TEXT NOT NULL,
+    claimed_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (team_id, period, period_key)
+);
+
+COMMIT;
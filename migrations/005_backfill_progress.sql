@@ -0,0 +1,18 @@
+-- Checkpoints for backfill.py. Each channel's row keeps the window it is
+-- backfilled over (Slack ts strings) and the conversations.history cursor
+-- of the next page to read; finished_at is set once the last page is in.
+BEGIN;
+
+CREATE TABLE backfill_progress (
+    team_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    oldest TEXT NOT NULL,
+    latest TEXT NOT NULL,
+    next_cursor TEXT,
+    messages INTEGER NOT NULL DEFAULT 0,
+    finished_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (team_id, channel_id)
+);
+
+COMMIT;
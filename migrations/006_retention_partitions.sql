@@ -0,0 +1,77 @@
+-- Adds monthly buckets and splits the daily tables into monthly range
+-- partitions. The metrics_maintenance job downsamples every daily partition
+-- older than METRICS_DAILY_RETENTION_DAYS into the monthly tables and then
+-- detaches and drops it, instead of deleting its rows one by one.
+-- It also creates partitions ahead of time; this migration creates them
+-- from the oldest existing day through three months from now.
+BEGIN;
+
+CREATE TABLE metrics_monthly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+);
+CREATE INDEX metrics_monthly_bucket_start_idx ON metrics_monthly (bucket_start);
+
+CREATE TABLE response_time_bins_monthly (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+);
+CREATE INDEX response_time_bins_monthly_bucket_start_idx ON response_time_bins_monthly (bucket_start);
+
+CREATE TABLE metrics_daily_partitioned (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    reaction_count INTEGER NOT NULL DEFAULT 0,
+    response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    response_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, channel_id)
+) PARTITION BY RANGE (bucket_start);
+
+CREATE TABLE response_time_bins_daily_partitioned (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    user_id TEXT NOT NULL,
+    bin_index INTEGER NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, bucket_start, user_id, bin_index)
+) PARTITION BY RANGE (bucket_start);
+
+-- Partitions are named <table>_pYYYYMM, which the maintenance job relies on
+DO $$
+DECLARE
+    parent TEXT;
+    month DATE;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['metrics_daily', 'response_time_bins_daily'] LOOP
+        EXECUTE format('SELECT date_trunc(''month'', COALESCE(MIN(bucket_start), NOW()))::date FROM %I', parent)
+            INTO month;
+        WHILE month <= (date_trunc('month', NOW()) + INTERVAL '3 months')::date LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           parent || '_p' || to_char(month, 'YYYYMM'), parent || '_partitioned',
+                           month, (month + INTERVAL '1 month')::date);
+            month := (month + INTERVAL '1 month')::date;
+        END LOOP;
+
+        EXECUTE format('INSERT INTO %I SELECT * FROM %I', parent || '_partitioned', parent);
+        EXECUTE format('DROP TABLE %I', parent);
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', parent || '_partitioned', parent);
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', parent || '_partitioned_pkey', parent || '_pkey');
+        EXECUTE format('CREATE INDEX %I ON %I (bucket_start)', parent || '_bucket_start_idx', parent);
+    END LOOP;
+END $$;
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Distinct-user HyperLogLog sketches per (team, channel, day), written by
+-- the metrics buffer and merged into monthly sketches past the daily
+-- retention. registers holds sketches.HyperLogLog.to_bytes(). The tables
+-- start empty; run `python retention.py seed-activity` once afterwards to
+-- build sketches for existing history from the counter tables.
+BEGIN;
+
+CREATE TABLE channel_activity_hll (
+    team_id TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    channel_id TEXT NOT NULL,
+    registers BYTEA NOT NULL,
+    PRIMARY KEY (team_id, bucket_start, channel_id)
+);
+CREATE INDEX channel_activity_hll_bucket_start_idx ON channel_activity_hll (bucket_start);
+
+CREATE TABLE channel_activity_hll_monthly (LIKE channel_activity_hll INCLUDING ALL);
+
+COMMIT;
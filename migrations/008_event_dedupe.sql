@@ -0,0 +1,12 @@
+-- Slack event_ids already received, shared by every worker and instance so a
+-- retry delivered to a different process is not counted twice. Rows older
+-- than EVENT_DEDUPE_TTL are ignored and deleted by the event_dedupe_expiry job.
+BEGIN;
+
+CREATE TABLE slack_event_ids (
+    event_id TEXT PRIMARY KEY,
+    seen_at TIMESTAMP NOT NULL
+);
+CREATE INDEX slack_event_ids_seen_at_idx ON slack_event_ids (seen_at);
+
+COMMIT;
@@ -0,0 +1,80 @@
+"""Packs metrics into Slack messages that stay within Block Kit limits.
+
+Rows are consumed lazily, so a report of any size is rendered one message at
+a time: lines are packed into mrkdwn sections of at most SECTION_CHAR_LIMIT
+characters and sections into messages of at most MESSAGE_BLOCK_LIMIT blocks.
+"""
+
+SECTION_CHAR_LIMIT = 3000
+MESSAGE_BLOCK_LIMIT = 50
+
+EMPTY_TEXT = "No user activity found."
+
+
+def metric_line(metric):
+    line = f"*User <@{metric['user_id']}>:* 👁️ {metric['message_count']} messages, 👍 {metric['reaction_count']} reactions, ⏱️ {metric['avg_response_time']} avg response"
+    if metric.get('p50_response_time', "N/A") != "N/A":
+        line += f" (p50 {metric['p50_response_time']}, p95 {metric['p95_response_time']})"
+    return line
+
+
+def channel_line(activity):
+    channel = f"<#{activity['channel_id']}>" if activity['channel_id'] else "All channels"
+    users = activity['active_users']
+    return f"*{channel}:* 👥 {users} active user{'' if users == 1 else 's'}"
+
+
+def section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def header_blocks(header):
+    return [
+        {"type": "header", "text": {"type": "plain_text", "text": header}},
+        {"type": "divider"}
+    ]
+
+
+def render_report(parts, fallback_text=None):
+    """Yields (blocks, text) messages for `parts`, an iterable of (header, metrics) pairs.
+
+    `metrics` may be any iterable, including a streaming query result, and
+    is rendered by metric_line() unless the part carries its own line
+    function as a third item, e.g. (header, activity, channel_line). The
+    first message's text is `fallback_text` (the first header by default)
+    and follow-up messages are marked as continued.
+    """
+    blocks = []
+    message_count = 0
+
+    def take_message():
+        nonlocal blocks, message_count
+        text = fallback_text if message_count == 0 else f"{fallback_text} (continued)"
+        message, blocks = blocks, []
+        message_count += 1
+        return message, text
+
+    for header, metrics, *renderer in parts:
+        render_line = renderer[0] if renderer else metric_line
+        if fallback_text is None:
+            fallback_text = header
+        # A header, its divider and at least one section must share a message
+        if len(blocks) + 3 > MESSAGE_BLOCK_LIMIT:
+            yield take_message()
+        blocks.extend(header_blocks(header))
+
+        lines = []
+        length = 0
+        for metric in metrics:
+            line = render_line(metric)
+            if lines and length + 1 + len(line) > SECTION_CHAR_LIMIT:
+                blocks.append(section("\n".join(lines)))
+                lines, length = [], 0
+                if len(blocks) == MESSAGE_BLOCK_LIMIT:
+                    yield take_message()
+            lines.append(line[:SECTION_CHAR_LIMIT])
+            length += (1 if length else 0) + len(lines[-1])
+        blocks.append(section("\n".join(lines) if lines else EMPTY_TEXT))
+
+    if blocks or message_count == 0:
+        yield take_message()
@@ -0,0 +1,271 @@
+"""Retention, downsampling and partition maintenance for the metrics tables.
+
+Activity moves from hourly to daily buckets in the hourly rollup, and from
+daily to monthly buckets here once it is older than the daily retention.
+On PostgreSQL the daily tables are range-partitioned by month (see
+migrations/006_retention_partitions.sql): a whole month is downsampled from
+its partition, which is then detached and dropped in the same transaction,
+so old data goes away without a large DELETE. Unpartitioned daily tables
+fall back to moving the rows with DELETE ... RETURNING. Daily distinct-user
+sketches have no partitions and are merged into monthly sketches in Python.
+
+    python retention.py seed-activity
+
+builds the distinct-user sketches once from the existing counters.
+"""
+import argparse
+import logging
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from metrics_store import (
+    ACTIVITY_TABLE, BIN_KEY_COLUMNS, BIN_VALUE_COLUMNS, DAILY_BINS_TABLE, DAILY_TABLE,
+    HOURLY_BINS_TABLE, HOURLY_TABLE, METRIC_KEY_COLUMNS, METRIC_VALUE_COLUMNS,
+    MONTHLY_ACTIVITY_TABLE, MONTHLY_BINS_TABLE, MONTHLY_TABLE, SKETCH_BATCH_SIZE,
+    day_bucket, merge_sketches, rollup_table, utcnow,
+)
+from sketches import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# (daily table, the hourly table rolled into it, the monthly table it is downsampled into, key columns, value columns)
+DAILY_TABLES = (
+    (DAILY_TABLE, HOURLY_TABLE, MONTHLY_TABLE, METRIC_KEY_COLUMNS, METRIC_VALUE_COLUMNS),
+    (DAILY_BINS_TABLE, HOURLY_BINS_TABLE, MONTHLY_BINS_TABLE, BIN_KEY_COLUMNS, BIN_VALUE_COLUMNS),
+)
+
+
+def month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def is_partitioned(session, table):
+    if session.bind.dialect.name != 'postgresql':
+        return False
+    return session.execute(text("""
+        SELECT 1 FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+        WHERE pg_class.relname = :table
+    """), {'table': table}).scalar() is not None
+
+
+def partitions(session, table):
+    """Names of the attached partitions of `table`."""
+    rows = session.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+    """), {'table': table}).fetchall()
+    return {row[0] for row in rows}
+
+
+def ensure_partitions(session, months_ahead=3):
+    """Creates the missing monthly partitions of the partitioned daily tables, without committing.
+
+    Partitions cover every month from the oldest hourly bucket still to be
+    rolled up through `months_ahead` months from now, so neither the rollup
+    nor a backfill of old history ever has nowhere to write. Returns the
+    names of the partitions created.
+    """
+    created = []
+    current = month_start(utcnow())
+    for daily, hourly, _, _, _ in DAILY_TABLES:
+        if not is_partitioned(session, daily):
+            continue
+        oldest = session.execute(text(f"SELECT MIN(bucket_start) FROM {hourly}")).scalar()
+        month = month_start(min(oldest, current) if oldest is not None else current)
+        existing = partitions(session, daily)
+        while month <= add_months(current, months_ahead):
+            name = partition_name(daily, month)
+            if name not in existing:
+                session.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {daily} "
+                    f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"
+                ))
+                created.append(name)
+            month = add_months(month, 1)
+    return created
+
+
+def downsample_daily(session, retention_days, keep_detached=False):
+    """Folds whole months of daily buckets older than `retention_days` into monthly buckets.
+
+    Each partition is downsampled, detached and dropped (or only detached,
+    with `keep_detached`) in its own transaction. Returns the number of
+    monthly rows written.
+    """
+    cutoff = month_start(utcnow() - timedelta(days=retention_days))
+    written = 0
+    for daily, _, monthly, key_columns, value_columns in DAILY_TABLES:
+        if not is_partitioned(session, daily):
+            written += rollup_table(session, daily, monthly, key_columns, value_columns, cutoff, truncate='month')
+            session.commit()
+            continue
+
+        prefix = f"{daily}_p"
+        for name in sorted(partitions(session, daily)):
+            if not name.startswith(prefix) or name[len(prefix):] >= f"{cutoff:%Y%m}":
+                continue
+            written += rollup_table(session, name, monthly, key_columns, value_columns, cutoff,
+                                    truncate='month', delete=False)
+            session.execute(text(f"ALTER TABLE {daily} DETACH PARTITION {name}"))
+            if not keep_detached:
+                session.execute(text(f"DROP TABLE {name}"))
+            session.commit()
+            logger.info(f"Downsampled {name} into {monthly} and {'detached' if keep_detached else 'dropped'} it")
+    return written
+
+
+def as_datetime(value):
+    # SQLite returns timestamps from text() queries as strings
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def sketches_by_key(pairs, update):
+    """Yields (key, HyperLogLog) for `pairs` of (key, value) with equal keys adjacent, calling update(sketch, value) for each value."""
+    key = sketch = None
+    for pair_key, value in pairs:
+        if pair_key != key:
+            if sketch is not None:
+                yield key, sketch
+            key, sketch = pair_key, HyperLogLog()
+        update(sketch, value)
+    if sketch is not None:
+        yield key, sketch
+
+
+def write_sketches(session, table, sketches, commit=False):
+    """Merges (key, HyperLogLog) pairs into `table` SKETCH_BATCH_SIZE at a time; returns the number of keys written."""
+    written = 0
+    batch = {}
+    for key, sketch in sketches:
+        if key in batch:
+            batch[key].update(sketch)
+        else:
+            batch[key] = sketch
+        if len(batch) >= SKETCH_BATCH_SIZE:
+            merge_sketches(session, table, batch)
+            written += len(batch)
+            batch = {}
+            if commit:
+                session.commit()
+    if batch:
+        merge_sketches(session, table, batch)
+        written += len(batch)
+        if commit:
+            session.commit()
+    return written
+
+
+def streamed(session, query, params, fetch_size):
+    for rows in session.execute(query.execution_options(yield_per=fetch_size), params).partitions(fetch_size):
+        yield from rows
+
+
+def downsample_activity(session, retention_days, fetch_size=500):
+    """Merges daily distinct-user sketches of whole months older than `retention_days` into monthly sketches.
+
+    Rows are read in (team, channel, day) order, so only one monthly sketch
+    is built at a time. Returns the number of monthly sketches written.
+    """
+    cutoff = month_start(utcnow() - timedelta(days=retention_days))
+    rows = streamed(session, text(f"""
+        SELECT team_id, channel_id, bucket_start, registers FROM {ACTIVITY_TABLE}
+        WHERE bucket_start < :cutoff
+        ORDER BY team_id, channel_id, bucket_start
+    """), {'cutoff': cutoff}, fetch_size)
+    pairs = (((team_id, month_start(as_datetime(bucket_start)), channel_id), registers)
+             for team_id, channel_id, bucket_start, registers in rows)
+    written = write_sketches(session, MONTHLY_ACTIVITY_TABLE, sketches_by_key(pairs, HyperLogLog.merge_bytes))
+    session.execute(text(f"DELETE FROM {ACTIVITY_TABLE} WHERE bucket_start < :cutoff"), {'cutoff': cutoff})
+    session.commit()
+    return written
+
+
+def seed_activity(session_factory, fetch_size=1000):
+    """Builds the distinct-user sketches from the counter tables, for activity counted before they existed.
+
+    Users seen per (team, channel, day) in the hourly and daily tables go
+    into day sketches, and users per month in the monthly table into month
+    sketches, so both are exact for existing history. Merging a user into a
+    sketch twice changes nothing, so this can run alongside live writes and
+    be run again. Each batch commits separately. Returns {table: sketches written}.
+    """
+    written = {}
+    with session_factory() as reader, session_factory() as writer:
+        rows = streamed(reader, text(f"""
+            SELECT team_id, channel_id, bucket_start, user_id FROM (
+                SELECT team_id, channel_id, bucket_start, user_id FROM {HOURLY_TABLE}
+                UNION ALL
+                SELECT team_id, channel_id, bucket_start, user_id FROM {DAILY_TABLE}
+            ) buckets
+            ORDER BY team_id, channel_id, bucket_start
+        """), {}, fetch_size)
+        pairs = (((team_id, day_bucket(as_datetime(bucket_start)), channel_id), user_id)
+                 for team_id, channel_id, bucket_start, user_id in rows)
+        written[ACTIVITY_TABLE] = write_sketches(writer, ACTIVITY_TABLE, sketches_by_key(pairs, HyperLogLog.add), commit=True)
+
+        rows = streamed(reader, text(f"""
+            SELECT team_id, channel_id, bucket_start, user_id FROM {MONTHLY_TABLE}
+            ORDER BY team_id, channel_id, bucket_start
+        """), {}, fetch_size)
+        pairs = (((team_id, as_datetime(bucket_start), channel_id), user_id)
+                 for team_id, channel_id, bucket_start, user_id in rows)
+        written[MONTHLY_ACTIVITY_TABLE] = write_sketches(writer, MONTHLY_ACTIVITY_TABLE, sketches_by_key(pairs, HyperLogLog.add), commit=True)
+    logger.info(f"Seeded distinct-user sketches from the counters: {written}")
+    return written
+
+
+def expire_monthly(session, retention_months):
+    """Deletes monthly buckets older than `retention_months`; 0 keeps them forever."""
+    if retention_months <= 0:
+        return 0
+    cutoff = add_months(month_start(utcnow()), -retention_months)
+    deleted = 0
+    for monthly in [table for _, _, table, _, _ in DAILY_TABLES] + [MONTHLY_ACTIVITY_TABLE]:
+        deleted += session.execute(
+            text(f"DELETE FROM {monthly} WHERE bucket_start < :cutoff"), {'cutoff': cutoff}
+        ).rowcount
+    session.commit()
+    return deleted
+
+
+def run_maintenance(session, daily_retention_days=400, monthly_retention_months=0,
+                    months_ahead=3, keep_detached=False):
+    """Creates upcoming partitions, downsamples old days and expires old months; returns a summary."""
+    created = ensure_partitions(session, months_ahead)
+    session.commit()
+    summary = {
+        'partitions_created': created,
+        'monthly_rows_written': downsample_daily(session, daily_retention_days, keep_detached),
+        'monthly_sketches_written': downsample_activity(session, daily_retention_days),
+        'monthly_rows_expired': expire_monthly(session, monthly_retention_months),
+    }
+    logger.info(f"Finished metrics maintenance: {summary}")
+    return summary
+
+
+def main(argv=None):
+    import app as bot
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['seed-activity'])
+    parser.parse_args(argv)
+    bot.create_app()
+    seed_activity(bot.Session)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Scheduler construction and the run ledger that keeps scheduled jobs single-shot.
+
+Every process may run a BackgroundScheduler. In 'cluster' mode the job
+definitions live in a shared SQLAlchemy jobstore. In either mode each firing
+runs only in the process that takes its lease in `job_runs`. Scheduled
+reports also claim each (team, period, period_key) in `report_runs` before
+posting it, so a retried or caught-up firing only posts what is missing.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import bindparam, text
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_MODES = ('local', 'cluster')
+
+# Jobs that must not be replicated go to the process-local store
+LOCAL_JOBSTORE = 'local'
+SHARED_JOBSTORE = 'default'
+
+
+def holder_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def build_scheduler(mode, engine, timezone, misfire_grace_time):
+    """BackgroundScheduler whose default jobstore is shared through `engine` in 'cluster' mode."""
+    if mode not in SCHEDULER_MODES:
+        raise ValueError(f"Unknown SCHEDULER_MODE {mode!r}, expected one of {SCHEDULER_MODES}")
+    jobstores = {
+        SHARED_JOBSTORE: SQLAlchemyJobStore(engine=engine) if mode == 'cluster' else MemoryJobStore(),
+        LOCAL_JOBSTORE: MemoryJobStore()
+    }
+    return BackgroundScheduler(
+        jobstores=jobstores,
+        job_defaults={'coalesce': True, 'misfire_grace_time': misfire_grace_time, 'max_instances': 1},
+        timezone=timezone
+    )
+
+
+def previous_fire_time(trigger, now, lookback):
+    """Latest time at or before `now`, and no earlier than `now - lookback`, at which `trigger` fires."""
+    fire_time = None
+    candidate = trigger.get_next_fire_time(None, now - lookback)
+    while candidate is not None and candidate <= now:
+        fire_time = candidate
+        candidate = trigger.get_next_fire_time(candidate, candidate + timedelta(microseconds=1))
+    return fire_time
+
+
+def acquire_job_run(session, job_id, run_key, lease_seconds):
+    """Takes the lease on one firing of `job_id`; False if it finished or another process holds it."""
+    now = datetime.utcnow()
+    row = session.execute(text("""
+        INSERT INTO job_runs (job_id, run_key, holder, lease_expires_at)
+        VALUES (:job_id, :run_key, :holder, :lease_expires_at)
+        ON CONFLICT (job_id, run_key) DO UPDATE SET
+            holder = EXCLUDED.holder,
+            lease_expires_at = EXCLUDED.lease_expires_at
+        WHERE job_runs.finished_at IS NULL AND job_runs.lease_expires_at < :now
+        RETURNING holder
+    """), {
+        'job_id': job_id,
+        'run_key': run_key,
+        'holder': holder_id(),
+        'lease_expires_at': now + timedelta(seconds=lease_seconds),
+        'now': now
+    }).fetchone()
+    session.commit()
+    return row is not None
+
+
+def finish_job_run(session, job_id, run_key, succeeded):
+    """Marks a held firing finished, or releases its lease at once so a later attempt may retry it."""
+    now = datetime.utcnow()
+    column = 'finished_at' if succeeded else 'lease_expires_at'
+    session.execute(text(f"""
+        UPDATE job_runs SET {column} = :now
+        WHERE job_id = :job_id AND run_key = :run_key AND holder = :holder
+    """), {'job_id': job_id, 'run_key': run_key, 'holder': holder_id(), 'now': now})
+    session.commit()
+
+
+def claim_report_runs(session, team_ids, period, period_key, stale_seconds):
+    """Claims the report for each team in one statement; returns the claimed team_ids.
+
+    A team is claimable unless its report was posted or another claim on it
+    is younger than `stale_seconds`.
+    """
+    if not team_ids:
+        return []
+    now = datetime.utcnow()
+    values = ", ".join(f"(:team_id_{i}, :period, :period_key, 'claimed', :holder, :now)" for i in range(len(team_ids)))
+    params = {f'team_id_{i}': team_id for i, team_id in enumerate(team_ids)}
+    params.update({
+        'period': period,
+        'period_key': period_key,
+        'holder': holder_id(),
+        'now': now,
+        'stale_before': now - timedelta(seconds=stale_seconds)
+    })
+    rows = session.execute(text(f"""
+        INSERT INTO report_runs (team_id, period, period_key, status, claimed_by, claimed_at)
+        VALUES {values}
+        ON CONFLICT (team_id, period, period_key) DO UPDATE SET
+            status = 'claimed',
+            claimed_by = EXCLUDED.claimed_by,
+            claimed_at = EXCLUDED.claimed_at
+        WHERE report_runs.status = 'failed'
+           OR (report_runs.status = 'claimed' AND report_runs.claimed_at < :stale_before)
+        RETURNING team_id
+    """), params).fetchall()
+    session.commit()
+    return [row[0] for row in rows]
+
+
+def finish_report_runs(session, team_ids, period, period_key, status):
+    """Sets the status ('posted' or 'failed') of reports this process claimed."""
+    if not team_ids:
+        return
+    session.execute(text("""
+        UPDATE report_runs SET status = :status, finished_at = :now
+        WHERE period = :period AND period_key = :period_key AND claimed_by = :holder AND team_id IN :team_ids
+    """).bindparams(bindparam('team_ids', expanding=True)), {
+        'status': status,
+        'now': datetime.utcnow(),
+        'period': period,
+        'period_key': period_key,
+        'holder': holder_id(),
+        'team_ids': list(team_ids)
+    })
+    session.commit()
@@ -0,0 +1,128 @@
+import hashlib
+import math
+import struct
+import zlib
+
+# Relative accuracy of the response-time sketch. Stored bin numbers depend on it,
+# so changing it makes existing rows meaningless.
+RESPONSE_TIME_ACCURACY = 0.02
+
+# Response times below this many seconds share the lowest bin
+MIN_RESPONSE_TIME = 0.001
+
+# Registers of the distinct-user sketches are 2 ** HLL_PRECISION; stored sketches
+# depend on it, so changing it makes existing rows meaningless
+HLL_PRECISION = 12
+
+
+class DDSketch:
+    """Log-bucketed quantile sketch (DDSketch) with mergeable integer bins.
+
+    A value x lands in bin ceil(log(x) / log(gamma)), gamma = (1 + a) / (1 - a),
+    and every quantile is returned within relative error `a`. Bins from any
+    number of sketches merge by adding their counts, which lets the database
+    store them as plain (bin, count) rows and merge them with SUM.
+    """
+
+    def __init__(self, relative_accuracy=RESPONSE_TIME_ACCURACY, min_value=MIN_RESPONSE_TIME):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.bins = {}
+        self.count = 0
+
+    def bin_for(self, value):
+        return math.ceil(math.log(max(value, self.min_value)) / self.log_gamma)
+
+    def add(self, value, count=1):
+        key = self.bin_for(value)
+        self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+
+    def merge_bins(self, bins):
+        for key, count in bins:
+            self.bins[key] = self.bins.get(key, 0) + count
+            self.count += count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+_response_times = DDSketch()
+
+
+def response_time_bin(seconds):
+    """Bin index of a response time in the sketch stored by the metrics tables."""
+    return _response_times.bin_for(seconds)
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2 ** precision one-byte registers.
+
+    Counts are within about 1.04 / sqrt(2 ** precision) relative error (1.6%
+    at the default precision) whatever the number of distinct values.
+    Sketches merge by keeping the larger of each register, so per-day
+    sketches combine into any window. to_bytes() stores a sketch with few
+    set registers as (index, rank) pairs, which also merge in time
+    proportional to the pairs rather than the registers.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    @classmethod
+    def from_bytes(cls, data, precision=HLL_PRECISION):
+        sketch = cls(precision)
+        sketch.merge_bytes(data)
+        return sketch
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def merge_bytes(self, data):
+        """Merges a sketch stored by to_bytes(); empty data is an empty sketch."""
+        if not data:
+            return
+        data = zlib.decompress(bytes(data))
+        if data[:1] == b'D':
+            self.registers = bytearray(map(max, self.registers, data[1:]))
+            return
+        registers = self.registers
+        for index, rank in struct.iter_unpack('>HB', data[1:]):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def to_bytes(self):
+        pairs = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(pairs) * 3 < self.size:
+            data = b'S' + b''.join(struct.pack('>HB', index, rank) for index, rank in pairs)
+        else:
+            data = b'D' + bytes(self.registers)
+        return zlib.compress(data)
+
+    def count(self):
+        size = self.size
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
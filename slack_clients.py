@@ -0,0 +1,106 @@
+import logging
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+from slack_sdk import WebClient
+from sqlalchemy import bindparam, text
+
+from instrumentation import stats
+
+logger = logging.getLogger(__name__)
+
+TOKENS_QUERY = text("SELECT team_id, bot_token FROM slack_bots WHERE team_id IN :team_ids").bindparams(
+    bindparam('team_ids', expanding=True)
+)
+
+
+class InstrumentedWebClient(WebClient):
+    """WebClient that records the latency of every Web API call by method."""
+
+    def api_call(self, api_method, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = super().api_call(api_method, **kwargs)
+            outcome = 'ok'
+            return response
+        finally:
+            stats.observe('slack_api_duration_seconds', time.perf_counter() - started, method=api_method, outcome=outcome)
+
+
+class SlackClientRegistry:
+    """Reuses one WebClient per team, built from the team's bot token in `slack_bots`.
+
+    Tokens are cached in memory for `ttl` seconds and the least recently used
+    teams are evicted past `max_size`, so posting normally never queries the
+    database. Teams without a stored token fall back to `default_token`.
+    All clients share one SSL context instead of loading the CA bundle for
+    every request.
+    """
+
+    client_class = InstrumentedWebClient
+
+    def __init__(self, session_factory, default_token=None, ttl=3600, max_size=1000, base_url=WebClient.BASE_URL):
+        self.session_factory = session_factory
+        self.base_url = base_url
+        self.ttl = ttl
+        self.max_size = max_size
+        self.ssl_context = ssl.create_default_context()
+        self.default_client = self.client_class(token=default_token, base_url=base_url, ssl=self.ssl_context)
+        # team_id -> (token, client, expires_at); token and client are None for teams without a row
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def client_for(self, team_id):
+        entry = self._cached(team_id)
+        if entry is None:
+            tokens = self._load_tokens([team_id])
+            entry = self._store(team_id, tokens.get(team_id))
+        client = entry[1]
+        return client if client is not None else self.default_client
+
+    def warm(self, team_ids):
+        """Loads the tokens of every uncached team in `team_ids` with a single query."""
+        missing = [team_id for team_id in team_ids if self._cached(team_id) is None]
+        if not missing:
+            return
+        tokens = self._load_tokens(missing)
+        for team_id in missing:
+            self._store(team_id, tokens.get(team_id))
+
+    def invalidate(self, team_id):
+        with self._lock:
+            self._entries.pop(team_id, None)
+
+    def _cached(self, team_id):
+        with self._lock:
+            entry = self._entries.get(team_id)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                return None
+            self._entries.move_to_end(team_id)
+            return entry
+
+    def _store(self, team_id, token):
+        with self._lock:
+            previous = self._entries.pop(team_id, None)
+            if token is None:
+                client = None
+            elif previous is not None and previous[0] == token:
+                client = previous[1]
+            else:
+                client = self.client_class(token=token, base_url=self.base_url, ssl=self.ssl_context)
+            entry = (token, client, time.monotonic() + self.ttl)
+            self._entries[team_id] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _load_tokens(self, team_ids):
+        with self.session_factory() as session:
+            rows = session.execute(TOKENS_QUERY, {'team_ids': list(team_ids)}).fetchall()
+        logger.debug(f"Loaded bot tokens for {len(rows)} of {len(team_ids)} teams")
+        return dict(rows)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+logger = logging.getLogger(__name__)
+
+# Slack errors worth another attempt; anything else (channel_not_found, invalid_auth, ...) fails at once
+RETRYABLE_ERRORS = {'ratelimited', 'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout'}
+
+
+class RateLimiter:
+    """Token bucket per key: `rate` calls per second with bursts of up to `burst`."""
+
+    def __init__(self, rate=1.0, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        while True:
+            wait = self._take(key)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self, key):
+        """Takes a token for `key` if one is available, without waiting."""
+        return self._take(key) == 0
+
+    async def acquire_async(self, key):
+        while True:
+            wait = self._take(key)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self, key):
+        """Takes a token for `key` and returns 0, or returns the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def penalize(self, key, seconds):
+        """Empties the bucket for `key` so the next call waits at least `seconds`."""
+        with self._lock:
+            self._buckets[key] = (-seconds * self.rate, time.monotonic())
+
+
+def retry_delay(error, attempt, attempts, backoff, limiter=None, limiter_key=None):
+    """Seconds to wait before retrying a Slack call that raised `error`, or None to give up.
+
+    A 429 waits for Slack's Retry-After, other retryable errors back off
+    exponentially from `backoff` seconds. With a limiter, a 429 penalizes its
+    key instead and 0 is returned: the next acquire waits out Retry-After for
+    every caller sharing the key.
+    """
+    if attempt == attempts:
+        return None
+    delay = backoff * 2 ** (attempt - 1)
+    if isinstance(error, SlackApiError):
+        code = error.response.get('error')
+        if code not in RETRYABLE_ERRORS and error.response.status_code < 500:
+            return None
+        if error.response.status_code == 429:
+            delay = float(error.response.headers.get('Retry-After', delay))
+        logger.warning(f"Slack call failed with {code}, retrying in {delay:.1f}s (attempt {attempt}/{attempts})")
+        if limiter is not None and error.response.status_code == 429:
+            limiter.penalize(limiter_key, delay)
+            return 0
+        return delay
+    logger.warning(f"Slack call failed with {error}, retrying in {delay:.1f}s (attempt {attempt}/{attempts})")
+    return delay
+
+
+def call_with_retry(func, limiter=None, limiter_key=None, attempts=3, backoff=1.0, **kwargs):
+    """Calls the Slack Web API method `func`, retrying rate limits and transient failures (see retry_delay)."""
+    for attempt in range(1, attempts + 1):
+        if limiter is not None:
+            limiter.acquire(limiter_key)
+        try:
+            return func(**kwargs)
+        except (SlackApiError, OSError) as e:
+            delay = retry_delay(e, attempt, attempts, backoff, limiter, limiter_key)
+            if delay is None:
+                raise
+        time.sleep(delay)
+
+
+async def call_with_retry_async(func, limiter=None, limiter_key=None, attempts=3, backoff=1.0, **kwargs):
+    """call_with_retry() for the coroutine methods of an AsyncWebClient."""
+    for attempt in range(1, attempts + 1):
+        if limiter is not None:
+            await limiter.acquire_async(limiter_key)
+        try:
+            return await func(**kwargs)
+        except (SlackApiError, OSError) as e:
+            delay = retry_delay(e, attempt, attempts, backoff, limiter, limiter_key)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+
+
+def post_thread(client, channel, messages, limiter=None, limiter_key=None):
+    """Posts (blocks, text) `messages` in order, the first to `channel` and the rest as replies in its thread."""
+    thread = None
+    for blocks, text in messages:
+        response = call_with_retry(
+            client.chat_postMessage,
+            limiter=limiter,
+            limiter_key=limiter_key,
+            channel=thread[0] if thread else channel,
+            thread_ts=thread[1] if thread else None,
+            blocks=blocks,
+            text=text
+        )
+        if thread is None:
+            thread = (response['channel'], response['ts'])
+    return thread
+
+
+async def post_thread_async(client, channel, messages, limiter=None, limiter_key=None):
+    """post_thread() with an AsyncWebClient."""
+    thread = None
+    for blocks, text in messages:
+        response = await call_with_retry_async(
+            client.chat_postMessage,
+            limiter=limiter,
+            limiter_key=limiter_key,
+            channel=thread[0] if thread else channel,
+            thread_ts=thread[1] if thread else None,
+            blocks=blocks,
+            text=text
+        )
+        if thread is None:
+            thread = (response['channel'], response['ts'])
+    return thread